@@ -19,16 +19,17 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import time
 import platform
-import array
 import string
 import pylink
 import numpy
 import psychopy
+from collections import deque
 from psychopy import visual, event, core, logging, prefs, monitors
 from psychopy.tools.coordinatetools import pol2cart
 from math import sin, cos, pi
-from PIL import Image, ImageDraw
+from PIL import Image
 from psychopy.sound import Sound
 
 
@@ -73,10 +74,16 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         if self._units != 'pix':
             self._display.setUnits('pix')
 
-        # Camera image set up
-        self._imagebuffer = array.array('I')
-        self._pal = None  # color pallete to use for camera image drawing
+        # Camera image set up, the camera frame is assembled line by line in
+        # a preallocated NumPy buffer, then shown with a single ImageStim
+        self._frame = None
+        self._pal = None  # color pallete (NumPy lookup table) for the camera
         self._size = (384, 320)
+        self._camImgStim = None
+        self._camImgSize = None
+        self._ovlScale = (1.0, 1.0)  # see _new_camera_frame()
+        # time of the most recent camera frames, see getCameraFPS()
+        self._camFrameTimes = deque(maxlen=60)
 
         # Initial setup for the mouse
         self._mouse = event.Mouse(False)
@@ -144,6 +151,13 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         self._animatedTarget = False
         self._movieTarget = None
         self._pictureTarget = None
+        # settings the current target was built with, see update_cal_target
+        self._calTargetKey = None
+        # the animated targets are redrawn at most once per screen refresh,
+        # see _update_animated_target()
+        self._framePeriod = win.monitorFramePeriod
+        self._lastTargetFlip = None
+        self._droppedFrames = 0
 
         # Configure calibration sounds (beeps), use ".wav" files
         if not DISABLE_AUDIO:
@@ -159,12 +173,19 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
                 #for root user or,  run the experiment with non root user.
                 DISABLE_AUDIO=True
 
+        # Play the beeps without waiting for them to end, so the next
+        # calibration target is not delayed; see setBlockingBeeps()
+        self._blockingBeeps = False
+        # nominal length of the waits skipped by the non-blocking beeps, and
+        # start time of the current calibration, see exit_cal_display()
+        self._beepWaitSkipped = 0.0
+        self._calStartTime = None
+
         # A reference to the tracker connection
         self._tracker = tracker
 
         # The tracker is running in mouse simulation mode?
         self._mouse_simulation = False
-        self.imgResize = None
 
     def __str__(self):
         """ Overwrite __str__ to show some information about the
@@ -184,6 +205,17 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
             self._h = int(self._h / 2.0)
             self._calibInst.pos =  (20 - self._w/2, self._h/2 - 20)
 
+    def getCameraFPS(self):
+        """ Frame rate of the camera image, over the last 60 frames"""
+
+        if len(self._camFrameTimes) < 2:
+            return 0.0
+        elapsed = self._camFrameTimes[-1] - self._camFrameTimes[0]
+        if elapsed <= 0:
+            return 0.0
+
+        return (len(self._camFrameTimes) - 1)/elapsed
+
     def getForegroundColor(self):
         """ Get the foreground color """
 
@@ -269,10 +301,28 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         else:
             self._error_beep.setSound(error_beep)
 
+    def setBlockingBeeps(self, blocking):
+        """ Wait for the beeps to end (0.5 sec, 1.2 sec for the error beep)
+        before returning to Pylink, as older versions of this library did
+
+        Parameters:
+            blocking--True to wait, False (default) to return immediately
+        """
+
+        self._blockingBeeps = blocking
+
     def update_cal_target(self):
         """ Make sure target stimuli is already memory when
             being used by draw_cal_target """ 
 
+        # The target is only built again if its settings changed since the
+        # previous setup_cal_display(), e.g., the 144 elements of the spiral
+        target_key = (self._calTarget, self._targetSize,
+                      str(self._foregroundColor), str(self._backgroundColor),
+                      self._pictureTarget, self._movieTarget)
+        if target_key == self._calTargetKey:
+            return
+
         if self._calTarget == 'picture':
             if self._pictureTarget is None:
                 print('ERROR: Provide a picture as the calibration target')
@@ -327,6 +377,8 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
                                                 color=self._backgroundColor,
                                                 units='pix')
 
+        self._calTargetKey = target_key
+
     def setup_cal_display(self):
         """ Set up the calibration display before entering
         the calibration/validation routine""" 
@@ -335,6 +387,9 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
 
         self._calibInst.autoDraw = True
         self._animatedTarget = False
+        self._beepWaitSkipped = 0.0
+        self._calStartTime = core.getTime()
+        self._droppedFrames = 0
         self.update_cal_target()
         
     def clear_cal_display(self):
@@ -357,6 +412,22 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         self._animatedTarget = False
         self.clear_cal_display()
 
+        # the skipped waits are the nominal beep lengths, an estimate of
+        # the time saved: part of a blocking wait would have overlapped the
+        # participant's next fixation anyway
+        if self._calStartTime is not None:
+            print('Calibration took %.1f sec' %
+                  (core.getTime() - self._calStartTime))
+            self._calStartTime = None
+        if self._beepWaitSkipped > 0:
+            print('Non-blocking beeps skipped %.1f sec of waits (estimate '
+                  'of the time saved)' % self._beepWaitSkipped)
+            self._beepWaitSkipped = 0.0
+
+        if self._droppedFrames > 0:
+            print('Animated target: %d dropped frames' % self._droppedFrames)
+            self._droppedFrames = 0
+
     def record_abort_hide(self):
         """ This function is called if aborted""" 
 
@@ -396,6 +467,7 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         if self._calTarget in ['spiral', 'movie']:
             # Hand over drawing to get_input_key()
             self._animatedTarget = True
+            self._lastTargetFlip = None
             if self._calTarget == 'movie':
                 if self._calibTar is not None:
                     self._calibTar.play()
@@ -421,18 +493,27 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
                 if beepid in [pylink.CAL_TARG_BEEP, pylink.DC_TARG_BEEP]:
                     if self._target_beep is not None:
                         self._target_beep.play()
-                        core.wait(0.5)
+                        self._wait_beep(0.5)
                 elif beepid in [pylink.CAL_ERR_BEEP, pylink.DC_ERR_BEEP]:
                     if self._error_beep is not None:
                         self._error_beep.play()
-                        core.wait(1.2)
+                        self._wait_beep(1.2)
                 elif beepid in [pylink.CAL_GOOD_BEEP, pylink.DC_GOOD_BEEP]:
                     if self._done_beep is not None:
                         self._done_beep.play()
-                        core.wait(0.5)
+                        self._wait_beep(0.5)
                 else:
                     pass
 
+    def _wait_beep(self, duration):
+        """ Wait for a beep to end in blocking mode, otherwise return
+        immediately and let the beep play over the next target"""
+
+        if self._blockingBeeps:
+            core.wait(duration)
+        else:
+            self._beepWaitSkipped += duration
+
     def getColorFromIndex(self, colorindex):
         """ Return psychopy colors for elements in the camera image""" 
 
@@ -452,55 +533,93 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
     def draw_line(self, x1, y1, x2, y2, colorindex):
         """ Draw a line. This is used for drawing crosshairs/squares""" 
 
-        color = self.getColorFromIndex(colorindex)
+        color = self._overlay_color(colorindex)
 
-        if self._size[0] > 192:
-            w, h = self._img.im.size
-            x1 = int((float(x1) / 192) * w)
-            x2 = int((float(x2) / 192) * w)
-            y1 = int((float(y1) / 160) * h)
-            y2 = int((float(y2) / 160) * h)
+        sx, sy = self._ovlScale
+        x1 = int(x1*sx)
+        x2 = int(x2*sx)
+        y1 = int(y1*sy)
+        y2 = int(y2*sy)
 
         # draw the line
         if not any([x < 0 for x in [x1, x2, y1, y2]]):
-            self._img.line([(x1, y1), (x2, y2)], color)
+            self._plot_line(x1, y1, x2, y2, color)
 
     def draw_lozenge(self, x, y, width, height, colorindex):
         """ Draw a lozenge to show the defined search limits
         (x,y) is top-left corner of the bounding box
         """ 
 
-        color = self.getColorFromIndex(colorindex)
+        color = self._overlay_color(colorindex)
 
-        if self._size[0] > 192:
-            w, h = self._img.im.size
-            x = int((float(x) / 192) * w)
-            y = int((float(y) / 160) * h)
-            width = int((float(width) / 192) * w)
-            height = int((float(height) / 160) * h)
+        sx, sy = self._ovlScale
+        x = int(x*sx)
+        y = int(y*sy)
+        width = int(width*sx)
+        height = int(height*sy)
 
         if width > height:
             rad = int(height / 2.)
             if rad == 0:
                 return
             else:
-                self._img.line([(x + rad, y), (x + width - rad, y)], color, 1)
-                self._img.line([(x + rad, y + height),
-                                (x + width - rad, y + height)], color, 1)
-                self._img.arc([x, y, x + rad*2, y + rad*2], 90, 270, color, 1)
-                self._img.arc([x + width - rad*2, y, x + width, y + height],
-                              270, 90, color, 1)
+                self._plot_line(x + rad, y, x + width - rad, y, color)
+                self._plot_line(x + rad, y + height,
+                                x + width - rad, y + height, color)
+                self._plot_arc([x, y, x + rad*2, y + rad*2], 90, 270, color)
+                self._plot_arc([x + width - rad*2, y, x + width, y + height],
+                               270, 90, color)
         else:
             rad = int(width / 2.)
             if rad == 0:
                 return
             else:
-                self._img.line([(x, y + rad), (x, y + height - rad)], color, 1)
-                self._img.line([(x + width, y + rad),
-                                (x + width, y + height - rad)], color, 1)
-                self._img.arc([x, y, x + rad*2, y + rad*2], 180, 360, color, 1)
-                self._img.arc([x, y + height-rad*2, x + rad*2, y + height],
-                              0, 180, color, 1)
+                self._plot_line(x, y + rad, x, y + height - rad, color)
+                self._plot_line(x + width, y + rad,
+                                x + width, y + height - rad, color)
+                self._plot_arc([x, y, x + rad*2, y + rad*2], 180, 360, color)
+                self._plot_arc([x, y + height-rad*2, x + rad*2, y + height],
+                               0, 180, color)
+
+    # The crosshairs and lozenges are rasterized straight into the camera
+    # frame buffer, in frame pixels; see _new_camera_frame() for the scale
+    # from the 192 x 160 tracker coordinates
+
+    def _overlay_color(self, colorindex):
+        """ Color of an overlay element, packed like the pallete entries"""
+
+        r, g, b = self.getColorFromIndex(colorindex)
+        return (b << 16) | (g << 8) | r
+
+    def _plot(self, xs, ys, color):
+        """ Set the frame pixels at (xs, ys), points outside are dropped"""
+
+        xs = numpy.rint(xs).astype(numpy.intp)
+        ys = numpy.rint(ys).astype(numpy.intp)
+        h, w = self._frame.shape
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        self._frame[ys[inside], xs[inside]] = color
+
+    def _plot_line(self, x1, y1, x2, y2, color):
+        """ One pixel wide line from (x1, y1) to (x2, y2)"""
+
+        n = max(abs(x2 - x1), abs(y2 - y1)) + 1
+        self._plot(numpy.linspace(x1, x2, n), numpy.linspace(y1, y2, n),
+                   color)
+
+    def _plot_arc(self, box, start, end, color):
+        """ One pixel wide arc of the ellipse inscribed in box, angles in
+        degrees, clockwise from 3 o'clock as in PIL"""
+
+        x0, y0, x1, y1 = box
+        rx = (x1 - x0)/2.0
+        ry = (y1 - y0)/2.0
+        if end < start:
+            end += 360
+        n = int(numpy.ceil((end - start)/180.0*pi*max(rx, ry))) + 1
+        theta = numpy.radians(numpy.linspace(start, end, max(n, 2)))
+        self._plot(x0 + rx + rx*numpy.cos(theta),
+                   y0 + ry + ry*numpy.sin(theta), color)
 
     def get_mouse_state(self):
         """ Get the current mouse position and status""" 
@@ -521,10 +640,7 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         # This function is constantly checked by the API,
         # so we could update the gabor here
         if self._animatedTarget:
-            if self._calTarget == 'spiral':
-                self._calibTar.phases -= 0.02
-            self._calibTar.draw()
-            self._display.flip()
+            self._update_animated_target()
         
         ky = []
         for keycode, modifier in event.getKeys(modifiers=True):
@@ -608,6 +724,35 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
 
         return ky
 
+    def _update_animated_target(self):
+        """ Redraw the animated target, at most once per screen refresh
+
+        Pylink polls get_input_key() continuously; drawing and flipping on
+        every poll kept the CPU busy, so between two refreshes we only
+        sleep. A flip later than 1.5 frame periods counts as dropped frames.
+        """
+
+        now = core.getTime()
+        if self._lastTargetFlip is not None and \
+                now < self._lastTargetFlip + self._framePeriod/2.0:
+            time.sleep(0.001)
+            return
+
+        if self._calTarget == 'spiral':
+            self._calibTar.phases -= 0.02
+        self._calibTar.draw()
+        # flip() waits for the vertical blank and returns its time
+        flip_time = self._display.flip()
+        if flip_time is None:
+            flip_time = core.getTime()
+
+        if self._lastTargetFlip is not None:
+            interval = flip_time - self._lastTargetFlip
+            if interval > 1.5*self._framePeriod:
+                n_frames = int(round(interval/self._framePeriod))
+                self._droppedFrames += n_frames - 1
+        self._lastTargetFlip = flip_time
+
     def exit_image_display(self):
         """ Clear the camera image""" 
 
@@ -617,6 +762,9 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         self._camImgRect.autoDraw = False
         self._display.flip()
 
+        if len(self._camFrameTimes) > 1:
+            print('Camera image: %.1f fps' % self.getCameraFPS())
+
     def alert_printf(self, msg):
         """ Print error messages.""" 
 
@@ -633,62 +781,94 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
         self._camImgRect.autoDraw = False
 
         self._size = (width, height)
+        self._camFrameTimes.clear()
+        self._new_camera_frame(width, height)
 
         return 1
 
+    def _new_camera_frame(self, width, height):
+        """ Allocate the camera frame buffer and the camera ImageStim, both
+        are reused for all the frames of that size"""
+
+        self._frame = numpy.zeros((height, width), dtype='<u4')
+        # scale of the overlays, the tracker draws them in a 192 x 160 image
+        if width > 192:
+            self._ovlScale = (width/192.0, height/160.0)
+        else:
+            self._ovlScale = (1.0, 1.0)
+        # Show the camera image at twice its size, the scaling is done
+        # by the graphics card
+        self._camImgSize = (width*2, height*2)
+        if self._camImgStim is None:
+            blank = Image.new('RGB', (width, height))
+            self._camImgStim = visual.ImageStim(self._display,
+                                                image=blank,
+                                                size=self._camImgSize,
+                                                units='pix')
+        else:
+            self._camImgStim.size = self._camImgSize
+
     def image_title(self, text):
         """ Draw title text below the camera image""" 
 
-        if self.imgResize is not None:
-            im_w, im_h = self.imgResize.size
+        if self._camImgSize is not None:
+            im_w, im_h = self._camImgSize
             self._title.pos = (0, - im_h/2.0 - self._msgHeight)
         else:
             self._title.pos = (0, -self._size[1]/2 - self._msgHeight)
         self._title.text = text
 
     def draw_image_line(self, width, line, totlines, buff):
-        """ Display image pixel by pixel, line by line""" 
+        """ Display image line by line, the pallete is applied to a
+        whole line at once""" 
 
-        i = 0
-        for i in range(width):
-            try:
-                self._imagebuffer.append(self._pal[buff[i]])
-            except:
-                pass
+        if self._frame is None or self._frame.shape != (totlines, width):
+            self._new_camera_frame(width, totlines)
+
+        # Pylink passes the pallete indices of the line as raw bytes
+        try:
+            indices = numpy.frombuffer(buff, dtype=numpy.uint8, count=width)
+        except (TypeError, ValueError):
+            indices = numpy.asarray(buff[:width], dtype=numpy.intp)
+
+        # lines are numbered from 1 to totlines
+        if self._pal is not None and 0 < line <= totlines:
+            self._pal.take(indices, mode='clip', out=self._frame[line-1])
 
         if line == totlines:
-            bufferv = self._imagebuffer.tostring()
-            img = Image.frombytes("RGBX", (width, totlines), bufferv)
-            self._img = ImageDraw.Draw(img)
+            # the crosshairs are drawn into the frame buffer, which is then
+            # wrapped without copy in a PIL image for the texture update
             self.draw_cross_hair()
-            self.imgResize = img.resize((width*2, totlines*2))
-            imgResizeVisual = visual.ImageStim(self._display,
-                                               image=self.imgResize,
-                                               units='pix')
-            imgResizeVisual.draw()
+            img = Image.frombuffer("RGBX", (width, totlines), self._frame,
+                                   'raw', "RGBX", 0, 1)
+            # update the texture of the camera ImageStim in place
+            self._camImgStim.image = img
+            self._camImgStim.draw()
             # Change the position of the camera title
             self._title.pos = (0, - totlines*2/2.0 - self._msgHeight)
             self._display.flip()
-            self._imagebuffer = array.array('I')
+            self._camFrameTimes.append(core.getTime())
 
     def set_image_palette(self, r, g, b):
-        """ Given a set of RGB colors, create a list of 24bit numbers
-        representing the pallet.
+        """ Given a set of RGB colors, create a lookup table of 24bit
+        numbers representing the pallet.
 
         i.e., RGB of (1,64,127) would be saved as 82047,
         or the number 00000001 01000000 011111111""" 
 
-        self._imagebuffer = array.array('I')
-
-        sz = len(r)
-        i = 0
-        self._pal = []
-        while i < sz:
-            rf = int(b[i])
-            gf = int(g[i])
-            bf = int(r[i])
-            self._pal.append((rf << 16) | (gf << 8) | (bf))
-            i = i+1
+        self._pal = self._build_palette(r, g, b)
+
+    @staticmethod
+    def _build_palette(r, g, b):
+        """ Pack the pallete colors into a little-endian uint32 array, in
+        one vectorized step. Read as bytes, each entry is R, G, B, X, the
+        "RGBX" raw mode we use for the camera image"""
+
+        r = numpy.asarray(r, dtype='<u4')
+        g = numpy.asarray(g, dtype='<u4')
+        b = numpy.asarray(b, dtype='<u4')
+
+        return (b << 16) | (g << 8) | r
 
 
 # A short testing script showing the basic usage of this library
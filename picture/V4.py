@@ -15,8 +15,16 @@ import os
 import time
 import sys
 from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
+import stimuli
+import prefetch
+import timing
+import timeline
+import messages
+import trialplan
+import session
+import transfer
+import backdrop
 from psychopy import visual, core, event, monitors, gui
-from PIL import Image  # for preparing the Host backdrop image
 from string import ascii_letters, digits
 
 # Switch to the script folder
@@ -41,18 +49,47 @@ dummy_mode = True
 # It is easier to debug the script in non-fullscreen mode
 full_screen = True
 
-# Store the parameters of all trials in a list, [condition, image]
-trials = [
-    ['cond_1', 'img_1.png'],
-    ['cond_2', 'img_2.png'],
-    ['cond_3', 'img_3.png'],
-    ['cond_4', 'img_4.png'],
-    ]
+# Number of times per second the tracker and the keyboard are checked during
+# the trial phases; the script sleeps in between instead of spinning
+phase_poll_rate = 200.0
+
+# Number of attempts to download the EDF file at the end of the session, and
+# whether to convert it to ASC with edf2asc right after (in the background).
+# The analysis reads the EDF file directly with edf.read_edf(), the ASC file
+# is only needed to look at the data in a text editor
+edf_transfer_retries = 3
+convert_edf_to_asc = False
+
+# The trials, one (condition, image) per row of the trial list, see
+# trialplan.py for the CSV and JSON formats
+trial_spec = 'trials.csv'
+# each trial is shown trial_repeats times, split in trial_blocks blocks; in
+# a block, the trials are in a random order with at most max_same_cond
+# trials of the same condition in a row (no limit if None)
+trial_repeats = 2
+trial_blocks = 1
+max_same_cond = None
+# set a seed to replay the order of a previous session
+trial_seed = None
+
+# Store the parameters of all trials in a list, (condition, image)
+trials = trialplan.load_spec(trial_spec)
 
 trials_test = [
-    ['cond_3', 'img_3.png']
+    trialplan.Trial('cond_3', 'img_3.png')
     ]
 
+# check all the images before we start, a missing image would otherwise
+# only show up in the middle of the session
+image_sizes = trialplan.validate(trials + trials_test, 'images',
+                                 extra_images=['base.png', 'repos.png'])
+
+# Set up a folder to store the EDF data files and the associated resources
+# e.g., files defining the interest areas used in each trial
+results_folder = 'Resultats_Pupillometry'
+if not os.path.exists(results_folder):
+    os.makedirs(results_folder)
+
 # Set up EDF data file name and local data folder
 #
 # The EDF data filename should not exceed 8 alphanumeric characters
@@ -90,26 +127,65 @@ while True:
         print('ERROR: Invalid EDF filename')
     elif len(edf_fname) > 8:
         print('ERROR: EDF filename should not exceed 8 characters')
+    elif edf_fname.upper() in session.edf_names(results_folder)[1]:
+        # the Host file of a resumed session, see session.py
+        print('ERROR: %s.EDF is used by another session' % edf_fname)
     else:
         break
 
-# Set up a folder to store the EDF data files and the associated resources
-# e.g., files defining the interest areas used in each trial
-results_folder = 'Resultats_Pupillometry'
-if not os.path.exists(results_folder):
-    os.makedirs(results_folder)
 
+# If the last session of this participant was interrupted (e.g., the
+# tracker got disconnected), offer to resume it with the trials that were
+# not run or failed, see session.py
+resume = False
+checkpoint_file = session.find_unfinished(results_folder, edf_fname)
+if checkpoint_file is not None:
+    checkpoint = session.SessionCheckpoint.load(checkpoint_file)
+    dlg = gui.Dlg('Resume session')
+    dlg.addText('Session %s was interrupted after %d of %d trials.' %
+                (checkpoint.session_identifier, checkpoint.n_done,
+                 len(checkpoint.plan)))
+    dlg.addField('Resume this session:', True)
+    ok_data = dlg.show()
+    resume = dlg.OK and bool(ok_data[0])
+
+if resume:
+    # keep the session folder and the trial order of the session
+    session_identifier = checkpoint.session_identifier
+    session_folder = os.path.dirname(checkpoint_file)
+    print('Resuming session %s, %d trials left, starting with trial %d' %
+          (session_identifier, len(checkpoint.pending),
+           checkpoint.next_trial + 1))
+else:
+    # We download EDF data file from the EyeLink Host PC to the local hard
+    # drive at the end of each testing session, here we rename the EDF to
+    # include session start date/time
+    time_str = time.strftime("_%Y_%m_%d_%H_%M", time.localtime())
+    session_identifier = edf_fname + time_str
+
+    # create a folder for the current testing session in the
+    # "Resultats_Pupillometry" folder
+    session_folder = os.path.join(results_folder, session_identifier)
+    if not os.path.exists(session_folder):
+        os.makedirs(session_folder)
 
-# We download EDF data file from the EyeLink Host PC to the local hard
-# drive at the end of each testing session, here we rename the EDF to
-# include session start date/time
-time_str = time.strftime("_%Y_%m_%d_%H_%M", time.localtime())
-session_identifier = edf_fname + time_str
+    # construct the randomized list of trials, it is saved in the
+    # checkpoint file so a resumed session keeps the same order
+    test_list = trialplan.make_plan(trials, trial_repeats, trial_blocks,
+                                    max_same_cond, trial_seed)
+    checkpoint = session.SessionCheckpoint.create(
+        os.path.join(session_folder, session.CHECKPOINT_FILE), edf_fname,
+        session_identifier, test_list)
 
-# create a folder for the current testing session in the "Resultats_Pupillometry" folder
-session_folder = os.path.join(results_folder, session_identifier)
-if not os.path.exists(session_folder):
-    os.makedirs(session_folder)
+test_list = checkpoint.plan
+
+# each run of the script records a new EDF segment, edf_fname.EDF for a new
+# session; local_edf_file is the name of its local copy. The file name of a
+# segment differs from the EDF file names of all the other sessions, so it
+# can not overwrite them on the Host
+edf_session_names, edf_segment_names = session.edf_names(results_folder)
+edf_file, local_edf_file = checkpoint.start_segment(
+    edf_session_names | edf_segment_names)
 
 
 
@@ -132,8 +208,30 @@ else:
         core.quit()
         sys.exit()
 
+# A resumed session: the EDF files of the previous segments should be in the
+# session folder, but the download at the end of a run is skipped when the
+# tracker got disconnected. Get the missing ones from the Host before the
+# new segment starts
+if resume:
+    for host_edf, local_edf, first_trial in checkpoint.segments[:-1]:
+        local_path = os.path.join(session_folder, local_edf)
+        if os.path.exists(local_path):
+            print('Segment %s: %s' % (host_edf, local_edf))
+            continue
+        if dummy_mode:
+            print('WARNING: segment %s is missing, %s was not downloaded' %
+                  (host_edf, local_edf))
+            continue
+        print('Segment %s: downloading the missing %s' % (host_edf,
+                                                          local_edf))
+        try:
+            transfer.EDFTransfer(el_tracker, retries=edf_transfer_retries)\
+                .download(host_edf, local_path)
+        except RuntimeError as error:
+            print('WARNING: segment %s is missing, %s could not be '
+                  'downloaded: %s' % (host_edf, local_edf, error))
+
 # Step 2: Open an EDF data file on the Host PC
-edf_file = edf_fname + ".EDF"
 try:
     el_tracker.openDataFile(edf_file)
 except RuntimeError as err:
@@ -207,6 +305,11 @@ win = visual.Window(fullscr=full_screen,
 # get the native screen resolution used by PsychoPy
 scn_width, scn_height = win.size
 
+# the images are stretched to full screen, report the ones with another
+# aspect ratio now that the screen size is known, from the sizes read at
+# the start
+trialplan.check_aspect_ratio(image_sizes, 'images', (scn_width, scn_height))
+
 # Pass the display pixel coordinates (left, top, right, bottom) to the tracker
 # see the EyeLink Installation Guide, "Customizing Screen Settings"
 el_coords = "screen_pixel_coords = 0 0 %d %d" % (scn_width - 1, scn_height - 1)
@@ -257,10 +360,39 @@ genv.setPictureTarget(os.path.join('images', 'fixTarget.bmp'))
 # Each parameter could be ''--default sound, 'off'--no sound, or a wav file
 genv.setCalibrationSounds('', '', '')
 
+# The beeps play without blocking the calibration, call
+# genv.setBlockingBeeps(True) to wait for each beep to end before the next
+# target shows up
+
 
 # Request Pylink to use the PsychoPy window we opened above for calibration
 pylink.openGraphicsEx(genv)
 
+# All the images used in the task
+task_images = set(['base.png', 'repos.png'] +
+                  [pic for cond, pic in trials + trials_test])
+
+# The backdrop of each trial is converted in the prefetch thread while the
+# previous trial is recording, see prepare_trial; an image shown again is
+# taken from the cache. The resized images are also kept in images/.backdrops,
+# so the next sessions skip the decoding
+backdrop_cache_dir = os.path.join('images', '.backdrops')
+backdrop_cache = backdrop.BackdropCache((scn_width, scn_height),
+                                        cache_dir=backdrop_cache_dir)
+
+# Send the Host backdrop of each trial before recording, from the main
+# thread, see backdrop.BackdropScheduler
+backdrop_scheduler = backdrop.BackdropScheduler(el_tracker)
+
+# Wait for the end of each trial phase, see timing.py
+phase_scheduler = timing.PhaseScheduler(phase_poll_rate, win)
+
+# Build the ImageStim of every image once, before the first trial, instead of
+# uploading new textures to the graphics card at the start of each trial
+stim_registry = stimuli.StimulusRegistry(win, (scn_width, scn_height))
+stim_registry.preload([os.path.join('images', f) for f in task_images])
+stim_registry.report()
+
 
 # define a few helper functions for trial handling
 
@@ -358,17 +490,24 @@ def terminate_task():
         el_tracker.closeDataFile()
 
 
-        # Show a file transfer message on the screen
-        msg = 'EDF data is transferring from EyeLink Host PC...'
-        show_msg(win, msg, wait_for_keypress=False)
-
-        # Download the EDF data file from the Host PC to a local data folder
+        # Download the EDF data file from the Host PC to a local data folder,
+        # the progress is shown on the screen and the size of the file is
+        # checked, see transfer.py
         # parameters: source_file_on_the_host, destination_file_on_local_drive
-        local_edf = os.path.join(session_folder, session_identifier + '.EDF')
+        clear_screen(win)
+        local_edf = os.path.join(session_folder, local_edf_file)
+        edf_transfer = transfer.EDFTransfer(el_tracker, win,
+                                            edf_transfer_retries,
+                                            color=genv.getForegroundColor(),
+                                            wrap_width=scn_width/2)
         try:
-            el_tracker.receiveDataFile(edf_file, local_edf)
+            edf_transfer.download(edf_file, local_edf)
         except RuntimeError as error:
             print('ERROR:', error)
+        else:
+            # start the ASC conversion, it keeps running after we quit
+            if convert_edf_to_asc:
+                transfer.convert_to_asc(local_edf)
 
         # Close the link to the tracker.
         el_tracker.close()
@@ -404,28 +543,35 @@ def abort_trial():
     return pylink.TRIAL_ERROR
 
 
-def run_trial(trial_pars, trial_index):
+def prepare_trial(trial_pars):
+    """ Prepare the Host backdrop of a trial, this is called from the
+    prefetch thread while the previous trial is recording; only the pixels
+    are converted here, the backdrop is sent from run_trial
+    trial_pars - a list containing trial parameters, e.g.,
+                ['cond_1', 'img_1.jpg']
+    """
+
+    cond, pic = trial_pars
+    return {'perception': backdrop_cache.get(os.path.join('images', pic))}
+
+
+def run_trial(trial_pars, trial_index, backdrops=None):
     """ Helper function specifying the events that will occur in a single trial
     trial_pars - a list containing trial parameters, e.g.,
                 ['cond_1', 'img_1.jpg']
     trial_index - record the order of trial presentation in the task
+    backdrops - the Host backdrops returned by prepare_trial(), prepared
+                here if None
     """
 
     # unpacking the trial parameters
     cond, pic = trial_pars
 
-    # load the image to display, here we stretch the image to fill full screen
-    img = visual.ImageStim(win,
-                           image=os.path.join('images', pic),
-                           size=(scn_width, scn_height))
-
-    repos= visual.ImageStim(win,
-                           image=os.path.join('images', 'repos.png'),
-                           size=(scn_width, scn_height))
-    
-    base = visual.ImageStim(win,
-                           image=os.path.join('images', 'base.png'),
-                           size=(scn_width, scn_height))
+    # the images to display, stretched to fill full screen; the ImageStim
+    # objects were built before the first trial, see stim_registry
+    img = stim_registry.get(os.path.join('images', pic))
+    repos = stim_registry.get(os.path.join('images', 'repos.png'))
+    base = stim_registry.get(os.path.join('images', 'base.png'))
 
     # get a reference to the currently active EyeLink connection
     el_tracker = pylink.getEYELINK()
@@ -436,61 +582,13 @@ def run_trial(trial_pars, trial_index):
     # clear the host screen before we draw the backdrop
     el_tracker.sendCommand('clear_screen 0')
 
-    # show a backdrop image on the Host screen, imageBackdrop() the recommended
-    # function, if you do not need to scale the image on the Host
-    # parameters: image_file, crop_x, crop_y, crop_width, crop_height,
-    #             x, y on the Host, drawing options
-##    el_tracker.imageBackdrop(os.path.join('images', pic),
-##                             0, 0, scn_width, scn_height, 0, 0,
-##                             pylink.BX_MAXCONTRAST)
-
-    # If you need to scale the backdrop image on the Host, use the old Pylink
-    # bitmapBackdrop(), which requires an additional step of converting the
-    # image pixels into a recognizable format by the Host PC.
-    # pixels = [line1, ...lineH], line = [pix1,...pixW], pix=(R,G,B)
-    #
-    # the bitmapBackdrop() command takes time to return, not recommended
-    # for tasks where the ITI matters, e.g., in an event-related fMRI task
-    # parameters: width, height, pixel, crop_x, crop_y,
-    #             crop_width, crop_height, x, y on the Host, drawing options
-    #
-    # Use the code commented below to convert the image and send the backdrop
-    perception = Image.open('images' + os.sep + pic)  # read image with PIL
-    rest = Image.open('images' + os.sep + 'repos.png') 
-    baseline = Image.open('images' + os.sep + 'base.png') 
-        
-    
-    
-    perception = perception.resize((scn_width, scn_height))
-    rest = rest.resize((scn_width, scn_height))
-    baseline = baseline.resize((scn_width, scn_height))
-    
-    img_pixels_perception = perception.load()  # access the pixel data of the image
-    img_pixels_rest = rest.load()
-    img_pixels_baseline = baseline.load()
-    
-    pixels_perception = [[img_pixels_perception[i, j] for i in range(scn_width)]
-              for j in range(scn_height)]
-    el_tracker.bitmapBackdrop(scn_width, scn_height, pixels_perception,
-                              0, 0, scn_width, scn_height,
-                              0, 0, pylink.BX_MAXCONTRAST)
-    
-    
-    pixels_rest = [[img_pixels_rest[i, j] for i in range(scn_width)]
-              for j in range(scn_height)]
-    el_tracker.bitmapBackdrop(scn_width, scn_height, pixels_rest,
-                              0, 0, scn_width, scn_height,
-                              0, 0, pylink.BX_MAXCONTRAST)
-    
-    
-    pixels_baseline = [[img_pixels_baseline[i, j] for i in range(scn_width)]
-              for j in range(scn_height)]
-    el_tracker.bitmapBackdrop(scn_width, scn_height, pixels_baseline,
-                              0, 0, scn_width, scn_height,
-                              0, 0, pylink.BX_MAXCONTRAST)
-    
+    # The Host backdrop is sent with bitmapBackdrop(), which scales the image
+    # to the Host screen but needs the pixels as lines of (R,G,B) tuples. The
+    # conversion was done in the prefetch thread, see prepare_trial and
+    # backdrop.py; the transfer is done below, before recording starts
+    if backdrops is None:
+        backdrops = prepare_trial(trial_pars)
 
-    
     # OPTIONAL: draw landmarks and texts on the Host screen
     # In addition to backdrop image, You may draw simples on the Host PC to use
     # as landmarks. For illustration purpose, here we draw some texts and a box
@@ -501,7 +599,41 @@ def run_trial(trial_pars, trial_index):
     right = int(scn_width/2.0) + 60
     bottom = int(scn_height/2.0) + 60
     draw_cmd = 'draw_filled_box %d %d %d %d 1' % (left, top, right, bottom)
-    el_tracker.sendCommand(draw_cmd)
+
+    # The phases of the trial; the messages of every phase are formatted
+    # here, before recording starts, see timeline.TrialTimeline
+    # Phase(name, stimulus, duration, onset message, Data Viewer image,
+    #       end message, keys ending the phase)
+    phases = [
+        timeline.Phase('base', base, 1.0, 'base_onset',
+                       '../../images/base.png', 'fin phase perception'),
+        timeline.Phase('image', img, 5.0, 'image_onset',
+                       '../../images/' + pic, 'fin phase perception'),
+        timeline.Phase('repos', repos, 10.0, 'repos_onset',
+                       '../../images/repos.png', 'fin phase repos'),
+        timeline.Phase('base2', base, 6.0, 'base_onset',
+                       '../../images/base.png', 'fin phase perception')]
+    # interest area logged at the onset of every phase, here a rectangular
+    # IA for illustration purposes, see the Data Viewer Manual, "Protocol
+    # for EyeLink Data to Viewer Integration"
+    # format: (<id>, <left>, <top>, <right>, <bottom>, [label])
+    ia_pars = (1, left, top, right, bottom, 'screen_center')
+    # the Data Viewer messages are not sent on the flips, they are queued
+    # and sent right after each onset with a time offset, see messages.py
+    msg_queue = messages.MessageQueue(el_tracker)
+    trial_timeline = timeline.TrialTimeline(
+        phases, phase_scheduler, el_tracker, (scn_width, scn_height),
+        areas=[ia_pars], msg_queue=msg_queue)
+    # trial variables known before the trial starts
+    trial_vars = ['!V TRIAL_VAR condition %s' % cond,
+                  '!V TRIAL_VAR image %s' % pic]
+
+    # The Host shows the image of the trial as backdrop, with the landmarks
+    # drawn over it. It is sent now, while the tracker is offline: Pylink
+    # is only called from the main thread, and no bitmap goes over the link
+    # during the recording
+    backdrop_scheduler.show('perception', backdrops['perception'],
+                            [draw_cmd])
 
     # send a "TRIALID" message to mark the start of a trial, see Data
     # Viewer User Manual, "Protocol for EyeLink Data to Viewer Integration"
@@ -553,315 +685,30 @@ def run_trial(trial_pars, trial_index):
     # Allocate some time for the tracker to cache some samples
     pylink.pumpDelay(100)
 
+    # reset the timing report of the trial phases
+    phase_scheduler.start_trial()
 
-    # Image base 
-     # show the image, and log a message to mark the onset of the image
-    base.draw()
-    win.flip
-    el_tracker.sendMessage('base_onset')
-    base_onset_time = core.getTime() 
-    
-    # Send a message to clear the Data Viewer screen, get it ready for
-    # drawing the pictures during visualization
-    bgcolor_RGB = (116, 116, 116)
-    el_tracker.sendMessage('!V CLEAR %d %d %d' % bgcolor_RGB)
- 
-    # send over a message to specify where the image is stored relative
-    # to the EDF data file, see Data Viewer User Manual, "Protocol for
-    # EyeLink Data to Viewer Integration"
-    bg_base = '../../images/' + 'base.png'
-    baseload_msg = '!V IMGLOAD CENTER %s %d %d %d %d' % (bg_base,
-                                                     int(scn_width/2.0),
-                                                     int(scn_height/2.0),
-                                                     int(scn_width),
-                                                     int(scn_height))
-    el_tracker.sendMessage(baseload_msg)
-    # send interest area messages to record in the EDF data file
-    # here we draw a rectangular IA, for illustration purposes
-    # format: !V IAREA RECTANGLE <id> <left> <top> <right> <bottom> [label]
-    # for all supported interest area commands, see the Data Viewer Manual,
-    # "Protocol for EyeLink Data to Viewer Integration"
-    ia_pars = (1, left, top, right, bottom, 'screen_center')
-    el_tracker.sendMessage('!V IAREA RECTANGLE %d %d %d %d %d %s' % ia_pars)
+    # show the phases, each one until its deadline or until the SPACEBAR is
+    # pressed; the tracker and the keyboard are polled at phase_poll_rate
+    status, RTs = trial_timeline.run()
+    RT_base, RT_img, RT_repos, RT_base2 = RTs
 
-    # show the image for 1-secs or until the SPACEBAR is pressed
-    event.clearEvents()  # clear cached PsychoPy events
-    RT_base = -1  # keep track of the response time
-    get_keypress = False
-    while not get_keypress:
-        # present the picture for a maximum of 1 seconds
-        if core.getTime() - base_onset_time >= 1.0:
-            el_tracker.sendMessage('fin phase perception')   
-            break
-
-        # abort the current trial if the tracker is no longer recording
-        error = el_tracker.isRecording()
-        if error is not pylink.TRIAL_OK:
-            el_tracker.sendMessage('tracker_disconnected')
-            abort_trial()
-            return error
-        
-        
-        
-        # check keyboard events
-        for keycode, modifier in event.getKeys(modifiers=True):
-            # Stop stimulus presentation when the spacebar is pressed
-            if keycode == 'space':
-                # send over a message to log the key press
-                el_tracker.sendMessage('key_pressed')
-
-                # get response time in ms, PsychoPy report time in sec
-                RT_base = int((core.getTime() - base_onset_time)*1000)
-                get_keypress = True
-
-            # Abort a trial if "ESCAPE" is pressed
-            if keycode == 'escape':
-                el_tracker.sendMessage('trial_skipped_by_user')
-                # clear the screen
-                clear_screen(win)
-                # abort trial
-                abort_trial()
-                return pylink.SKIP_TRIAL
-
-            # Terminate the task if Ctrl-c
-            if keycode == 'c' and (modifier['ctrl'] is True):
-                el_tracker.sendMessage('terminated_by_user')
-                terminate_task()
-                return pylink.ABORT_EXPT
-        
-        
-
-
-
-    #image triangle
-    # show the image, and log a message to mark the onset of the image
-    img.draw()
-    win.flip()
-    el_tracker.sendMessage('image_onset')
-    img_onset_time = core.getTime()  # record the image onset time
-
-    # Send a message to clear the Data Viewer screen, get it ready for
-    # drawing the pictures during visualization
-    bgcolor_RGB = (116, 116, 116)
-    el_tracker.sendMessage('!V CLEAR %d %d %d' % bgcolor_RGB)
-
-    # send over a message to specify where the image is stored relative
-    # to the EDF data file, see Data Viewer User Manual, "Protocol for
-    # EyeLink Data to Viewer Integration"
-    bg_image = '../../images/' + pic
-    imgload_msg = '!V IMGLOAD CENTER %s %d %d %d %d' % (bg_image,
-                                                        int(scn_width/2.0),
-                                                        int(scn_height/2.0),
-                                                        int(scn_width),
-                                                        int(scn_height))
-    el_tracker.sendMessage(imgload_msg)
-
-    # send interest area messages to record in the EDF data file
-    # here we draw a rectangular IA, for illustration purposes
-    # format: !V IAREA RECTANGLE <id> <left> <top> <right> <bottom> [label]
-    # for all supported interest area commands, see the Data Viewer Manual,
-    # "Protocol for EyeLink Data to Viewer Integration"
-    ia_pars = (1, left, top, right, bottom, 'screen_center')
-    el_tracker.sendMessage('!V IAREA RECTANGLE %d %d %d %d %d %s' % ia_pars)
-
-    # show the image for 5-secs or until the SPACEBAR is pressed
-    event.clearEvents()  # clear cached PsychoPy events
-    RT_img = -1  # keep track of the response time
-    get_keypress = False
-    while not get_keypress:
-        # present the picture for a maximum of 5 seconds
-        if core.getTime() - img_onset_time >= 5.0:
-            el_tracker.sendMessage('fin phase perception')   
-            break
-
-        # abort the current trial if the tracker is no longer recording
-        error = el_tracker.isRecording()
-        if error is not pylink.TRIAL_OK:
-            el_tracker.sendMessage('tracker_disconnected')
-            abort_trial()
-            return error
-        
-        # check keyboard events
-        for keycode, modifier in event.getKeys(modifiers=True):
-            # Stop stimulus presentation when the spacebar is pressed
-            if keycode == 'space':
-                # send over a message to log the key press
-                el_tracker.sendMessage('key_pressed')
-
-                # get response time in ms, PsychoPy report time in sec
-                RT_img = int((core.getTime() - img_onset_time)*1000)
-                get_keypress = True
-
-            # Abort a trial if "ESCAPE" is pressed
-            if keycode == 'escape':
-                el_tracker.sendMessage('trial_skipped_by_user')
-                # clear the screen
-                clear_screen(win)
-                # abort trial
-                abort_trial()
-                return pylink.SKIP_TRIAL
-
-            # Terminate the task if Ctrl-c
-            if keycode == 'c' and (modifier['ctrl'] is True):
-                el_tracker.sendMessage('terminated_by_user')
-                terminate_task()
-                return pylink.ABORT_EXPT
-
-    
-
-
-    # Image repos 
-    # show the image, and log a message to mark the onset of the image
-    repos.draw()
-    win.flip
-    el_tracker.sendMessage('repos_onset')
-    repos_onset_time = core.getTime() 
-    
-    # Send a message to clear the Data Viewer screen, get it ready for
-    # drawing the pictures during visualization
-    bgcolor_RGB = (116, 116, 116)
-    el_tracker.sendMessage('!V CLEAR %d %d %d' % bgcolor_RGB)
- 
-    # send over a message to specify where the image is stored relative
-    # to the EDF data file, see Data Viewer User Manual, "Protocol for
-    # EyeLink Data to Viewer Integration"
-    bg_repos = '../../images/' + 'repos.png'
-    reposload_msg = '!V IMGLOAD CENTER %s %d %d %d %d' % (bg_repos,
-                                                     int(scn_width/2.0),
-                                                     int(scn_height/2.0),
-                                                     int(scn_width),
-                                                     int(scn_height))
-    el_tracker.sendMessage(reposload_msg)
-    # send interest area messages to record in the EDF data file
-    # here we draw a rectangular IA, for illustration purposes
-    # format: !V IAREA RECTANGLE <id> <left> <top> <right> <bottom> [label]
-    # for all supported interest area commands, see the Data Viewer Manual,
-    # "Protocol for EyeLink Data to Viewer Integration"
-    ia_pars = (1, left, top, right, bottom, 'screen_center')
-    el_tracker.sendMessage('!V IAREA RECTANGLE %d %d %d %d %d %s' % ia_pars)
-
-    # show the image for 10-secs or until the SPACEBAR is pressed
-    event.clearEvents()  # clear cached PsychoPy events
-    RT_repos = -1  # keep track of the response time
-    get_keypress = False
-    while not get_keypress:
-        # present the picture for a maximum of 10 seconds
-        if core.getTime() - repos_onset_time >= 10.0:
-            el_tracker.sendMessage('fin phase repos')   
-            break
-
-        # abort the current trial if the tracker is no longer recording
-        error = el_tracker.isRecording()
-        if error is not pylink.TRIAL_OK:
-            el_tracker.sendMessage('tracker_disconnected')
-            abort_trial()
-            return error
-        
-        
-        # check keyboard events
-        for keycode, modifier in event.getKeys(modifiers=True):
-            # Stop stimulus presentation when the spacebar is pressed
-            if keycode == 'space':
-                # send over a message to log the key press
-                el_tracker.sendMessage('key_pressed')
-
-                # get response time in ms, PsychoPy report time in sec
-                RT_repos = int((core.getTime() - repos_onset_time)*1000)
-                get_keypress = True
-
-            # Abort a trial if "ESCAPE" is pressed
-            if keycode == 'escape':
-                el_tracker.sendMessage('trial_skipped_by_user')
-                # clear the screen
-                clear_screen(win)
-                # abort trial
-                abort_trial()
-                return pylink.SKIP_TRIAL
-
-            # Terminate the task if Ctrl-c
-            if keycode == 'c' and (modifier['ctrl'] is True):
-                el_tracker.sendMessage('terminated_by_user')
-                terminate_task()
-                return pylink.ABORT_EXPT
-        
-        
-  
-    
-    # Image base 
-    # show the image, and log a message to mark the onset of the image
-    base.draw()
-    win.flip
-    el_tracker.sendMessage('base_onset')
-    base2_onset_time = core.getTime() 
-    
-    # Send a message to clear the Data Viewer screen, get it ready for
-    # drawing the pictures during visualization
-    bgcolor_RGB = (116, 116, 116)
-    el_tracker.sendMessage('!V CLEAR %d %d %d' % bgcolor_RGB)
- 
-    # send over a message to specify where the image is stored relative
-    # to the EDF data file, see Data Viewer User Manual, "Protocol for
-    # EyeLink Data to Viewer Integration"
-    bg_base = '../../images/' + 'base.png'
-    baseload_msg = '!V IMGLOAD CENTER %s %d %d %d %d' % (bg_base,
-                                                     int(scn_width/2.0),
-                                                     int(scn_height/2.0),
-                                                     int(scn_width),
-                                                     int(scn_height))
-    el_tracker.sendMessage(baseload_msg)
-    # send interest area messages to record in the EDF data file
-    # here we draw a rectangular IA, for illustration purposes
-    # format: !V IAREA RECTANGLE <id> <left> <top> <right> <bottom> [label]
-    # for all supported interest area commands, see the Data Viewer Manual,
-    # "Protocol for EyeLink Data to Viewer Integration"
-    ia_pars = (1, left, top, right, bottom, 'screen_center')
-    el_tracker.sendMessage('!V IAREA RECTANGLE %d %d %d %d %d %s' % ia_pars)
-
-    # show the image for 6-secs or until the SPACEBAR is pressed
-    event.clearEvents()  # clear cached PsychoPy events
-    RT_base2 = -1  # keep track of the response time
-    get_keypress = False
-    while not get_keypress:
-        # present the picture for a maximum of 5 seconds
-        if core.getTime() - base2_onset_time >= 6.0:
-            el_tracker.sendMessage('fin phase perception')   
-            break
-
-        # abort the current trial if the tracker is no longer recording
-        error = el_tracker.isRecording()
-        if error is not pylink.TRIAL_OK:
-            el_tracker.sendMessage('tracker_disconnected')
-            abort_trial()
-            return error    
-    
-    
+    # Abort a trial if "ESCAPE" is pressed
+    if status == pylink.SKIP_TRIAL:
+        # clear the screen
+        clear_screen(win)
+        abort_trial()
+        return status
 
+    # Terminate the task if Ctrl-c
+    if status == pylink.ABORT_EXPT:
+        terminate_task()
+        return status
 
-        # check keyboard events
-        for keycode, modifier in event.getKeys(modifiers=True):
-            # Stop stimulus presentation when the spacebar is pressed
-            if keycode == 'space':
-                # send over a message to log the key press
-                el_tracker.sendMessage('key_pressed')
-
-                # get response time in ms, PsychoPy report time in sec
-                RT_base2 = int((core.getTime() - base2_onset_time)*1000)
-                get_keypress = True
-
-            # Abort a trial if "ESCAPE" is pressed
-            if keycode == 'escape':
-                el_tracker.sendMessage('trial_skipped_by_user')
-                # clear the screen
-                clear_screen(win)
-                # abort trial
-                abort_trial()
-                return pylink.SKIP_TRIAL
-
-            # Terminate the task if Ctrl-c
-            if keycode == 'c' and (modifier['ctrl'] is True):
-                el_tracker.sendMessage('terminated_by_user')
-                terminate_task()
-                return pylink.ABORT_EXPT
+    # abort the current trial if the tracker is no longer recording
+    if status is not pylink.TRIAL_OK:
+        abort_trial()
+        return status
 
     # clear the screen
     clear_screen(win)
@@ -875,28 +722,38 @@ def run_trial(trial_pars, trial_index):
 
     # record trial variables to the EDF data file, for details, see Data
     # Viewer User Manual, "Protocol for EyeLink Data to Viewer Integration"
-    el_tracker.sendMessage('!V TRIAL_VAR condition %s' % cond)
-    el_tracker.sendMessage('!V TRIAL_VAR image %s' % pic)
-    el_tracker.sendMessage('!V TRIAL_VAR RT_base %d' % RT_base)
-    el_tracker.sendMessage('!V TRIAL_VAR RT_img %d' % RT_img)
-    el_tracker.sendMessage('!V TRIAL_VAR RT_repos %d' % RT_repos)
-    el_tracker.sendMessage('!V TRIAL_VAR RT_base2 %d' % RT_base2)
+    trial_vars.extend(['!V TRIAL_VAR RT_base %d' % RT_base,
+                       '!V TRIAL_VAR RT_img %d' % RT_img,
+                       '!V TRIAL_VAR RT_repos %d' % RT_repos,
+                       '!V TRIAL_VAR RT_base2 %d' % RT_base2])
+    # the recording is over, nothing is timing critical here and the
+    # TRIAL_VARs belong to no event, so they are sent without offset
+    for msg in trial_vars:
+        el_tracker.sendMessage(msg)
 
 
     # send a 'TRIAL_RESULT' message to mark the end of trial, see Data
     # Viewer User Manual, "Protocol for EyeLink Data to Viewer Integration"
     el_tracker.sendMessage('TRIAL_RESULT %d' % pylink.TRIAL_OK)
     
+    # onset/offset error of each trial phase
+    print('Trial %d timing:' % trial_index)
+    phase_scheduler.report()
+
     show_question(win, wait_for_keypress=False)
 
+    return pylink.TRIAL_OK
+
 
 
     
 # Step 5: Set up the camera and calibrate the tracker
 
-# Show the task instructions
+# Show the task instructions, a resumed session goes straight to the
+# calibration
 intro='Vous allez participer à un test de visualisation mentale. Ce test se décompose en 4 phases.\n\n1) Vous allez voir une forme géométrique apparaître au centre de l\'écran.\n2) La forme va disparaître et un écran noir va la remplacer.\n3) Lorsque l\'écran redeviendra gris et que vous entendrez le signal sonore, vous allez devoir vous remémorer mentalement la forme vue lors de la première étape tout en gardant les yeux fixés sur la croix centrale. La fin de cette phase de visualisation mentale sera marquée par le même signal sonore qu\'au début.\n4) Vous devrez répondre à 2 questions, la première portant sur la netteté de votre visualisation et la seconde pour déclarer si vous avez eu un effet d\'image rémanente.\n\n(Appuyer sur la barre d\'espace pour continuer)'
-show_msg(win, intro)
+if not resume:
+    show_msg(win, intro)
 
 #task_msg = 'In the task, you may press the SPACEBAR to end a trial\n' + \
    # '\nPress Ctrl-C to if you need to quit the task early\n'
@@ -915,25 +772,35 @@ if not dummy_mode:
 
 # Step 6: Run the test experimental trial
 
-phase_test_msg='Vous allez maintenant avoir une première phase de test où la phase de repos sera grise.\n\nAppuyez sur ENTER, pour commencer'
-show_msg(win, phase_test_msg)
-run_trial(trials_test, 1)
+# a resumed session skips the test trial
+if not resume:
+    phase_test_msg='Vous allez maintenant avoir une première phase de test où la phase de repos sera grise.\n\nAppuyez sur ENTER, pour commencer'
+    show_msg(win, phase_test_msg)
+    for trial_pars in trials_test:
+        run_trial(trial_pars, 1)
 
-text = 'Le premier test est maintenant terminé !\n\nVous allez maintenant avoir un test similaire où la phase de repos sera un masque de bruit blanc.\n\n(Appuyer sur ENTRÉE pour continuer)'
-show_msg(win, text)
+    text = 'Le premier test est maintenant terminé !\n\nVous allez maintenant avoir un test similaire où la phase de repos sera un masque de bruit blanc.\n\n(Appuyer sur ENTRÉE pour continuer)'
+    show_msg(win, text)
 
 # Step 7: Run the experimental trials, index all the trials
 
-
-# construct a list of X trials
-test_list = trials[:]*2
-
-
-
-trial_index = 1
-for trial_pars in test_list:
-    run_trial(trial_pars, trial_index)
-    trial_index += 1
+# the backdrops of the next trial are prepared in a background thread while
+# the current one is running; a resumed session runs the trials that were
+# not run yet or failed, each trial keeps its position in the plan as
+# TRIALID
+positions = checkpoint.pending
+for i, (trial_pars, backdrops) in enumerate(prefetch.TrialPrefetcher(
+        prepare_trial, [test_list[position] for position in positions])):
+    status = run_trial(trial_pars, positions[i] + 1, backdrops)
+    # save the progress of the session, after the TRIAL_RESULT message
+    checkpoint.trial_done(positions[i], status)
+
+# the failed trials are run again when the session is resumed
+if checkpoint.pending:
+    print('WARNING: %d trials failed, resume session %s to run them again' %
+          (len(checkpoint.pending), session_identifier))
+else:
+    checkpoint.finish()
 
 # Step 8: disconnect, download the EDF file, then terminate the task
 terminate_task()
\ No newline at end of file
@@ -0,0 +1,404 @@
+#########################################
+#
+# Pupillometry - ASC file reader
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# Read the ASC files converted from the EDF files (edf2asc) into NumPy
+# arrays, one array per column, e.g.
+#
+#     data = asc.read_asc('Resultats_Pupillometry/<session>/<session>.asc')
+#     data.samples['pupil'], data.messages['time'], data.blinks['start']
+#
+# An ASC file is mostly sample lines, one per ms at 1000 Hz:
+#
+#     246222	 1001.5	  849.2	 7648.0	  127.0	...
+#
+# (time, gaze x, gaze y, pupil, input port, flags), '.' marking a missing
+# value (e.g., during a blink). The file is read in large chunks and the
+# sample lines of a chunk are converted in one go with NumPy: the flags are
+# masked out, the missing values are replaced by 'nan' and all the numbers
+# of the chunk are parsed by a single numpy.fromstring() call, so no Python
+# object is created per sample.
+#
+# The other lines are the events (MSG, SFIX/EFIX, SSACC/ESACC, SBLINK/EBLINK,
+# START/END, INPUT) and the recording headers. There are a few hundred of
+# them per session, they are decoded line by line. The start events (SFIX,
+# SSACC, SBLINK) are skipped, their time is repeated in the end events.
+
+from __future__ import division
+from __future__ import print_function
+
+import numpy
+
+
+# columns of the end events, after the eye ('L' or 'R')
+FIXATION_COLUMNS = ['start', 'end', 'duration', 'x', 'y', 'pupil']
+SACCADE_COLUMNS = ['start', 'end', 'duration', 'start_x', 'start_y',
+                   'end_x', 'end_y', 'amplitude', 'peak_velocity']
+BLINK_COLUMNS = ['start', 'end', 'duration']
+
+_NL = ord('\n')
+_TAB = ord('\t')
+_SPACE = ord(' ')
+_DOT = ord('.')
+_CR = ord('\r')
+# first letter of the lines decoded as events
+_EVENT_INITIALS = [ord(c) for c in 'MSEI']
+
+
+class ASCData(object):
+    """ The content of an ASC file, as column arrays
+
+    Attributes:
+        samples--dict column name -> array, see sample_columns
+        sample_columns--names of the sample columns, e.g., ['time', 'x',
+                        'y', 'pupil', 'input'] for a monocular recording
+        rate--sampling rate (Hz)
+        messages--{'time': int64, 'text': object} arrays
+        fixations, saccades, blinks--dict with an 'eye' array ('L' or 'R')
+                                     and the *_COLUMNS arrays
+        recordings--{'start': ..., 'end': ...}, one row per START/END
+        inputs--{'time': ..., 'value': ...}, the INPUT events
+        n_lines--number of lines in the file
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self.sample_columns = []
+        self.rate = None
+        self.messages = {}
+        self.fixations = {}
+        self.saccades = {}
+        self.blinks = {}
+        self.recordings = {}
+        self.inputs = {}
+        self.n_lines = 0
+
+    def __len__(self):
+        if 'time' not in self.samples:
+            return 0
+        return len(self.samples['time'])
+
+
+def sample_columns(samples_line):
+    """ Names of the sample columns, from the SAMPLES line of a recording,
+    e.g., SAMPLES GAZE RIGHT RATE 1000.00 TRACKING CR FILTER 2 INPUT"""
+
+    words = samples_line.split()
+    left = 'LEFT' in words
+    right = 'RIGHT' in words
+
+    columns = ['time']
+    if left and right:
+        columns += ['x_left', 'y_left', 'pupil_left',
+                    'x_right', 'y_right', 'pupil_right']
+        if 'VEL' in words:
+            columns += ['vx_left', 'vy_left', 'vx_right', 'vy_right']
+    else:
+        columns += ['x', 'y', 'pupil']
+        if 'VEL' in words:
+            columns += ['vx', 'vy']
+    if 'RES' in words:
+        columns += ['res_x', 'res_y']
+    if 'INPUT' in words:
+        columns += ['input']
+
+    return columns
+
+
+class _Reader(object):
+    """ Parsing state, kept across the chunks of a file"""
+
+    def __init__(self):
+        self.columns = None
+        self.rate = None
+        self.sample_chunks = []
+        self.messages = []
+        self.fixations = []
+        self.saccades = []
+        self.blinks = []
+        self.starts = []
+        self.ends = []
+        self.inputs = []
+        self.n_lines = 0
+
+    def feed(self, chunk):
+        """ Parse a chunk of whole lines (bytes, ending with a newline)"""
+
+        buf = numpy.frombuffer(chunk, dtype=numpy.uint8)
+        ends = numpy.flatnonzero(buf == _NL)
+        if len(ends) == 0:
+            return
+        starts = numpy.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        self.n_lines += len(ends)
+
+        # skip the empty lines
+        non_empty = starts < ends
+        starts = starts[non_empty]
+        ends = ends[non_empty]
+        first = buf[starts]
+
+        # events first, the SAMPLES line tells the layout of the samples
+        is_event = numpy.isin(first, _EVENT_INITIALS)
+        for start, end in zip(starts[is_event], ends[is_event]):
+            self._event(chunk[start:end].decode('latin-1'))
+
+        is_sample = (first >= ord('0')) & (first <= ord('9'))
+        if numpy.any(is_sample):
+            self._samples(buf, starts[is_sample], ends[is_sample])
+
+    def _samples(self, buf, starts, ends):
+        """ Convert all the sample lines of a chunk"""
+
+        if self.columns is None:
+            raise ValueError('Samples found before the SAMPLES line')
+        n_columns = len(self.columns)
+
+        # the flags are after the last numeric column: cut each line at its
+        # n_columns-th tab, or at its end if there are no flags
+        tabs = numpy.flatnonzero(buf == _TAB)
+        first_tab = numpy.searchsorted(tabs, starts)
+        cut_tab = first_tab + n_columns - 1
+        cuts = ends.copy()
+        has_flags = cut_tab < len(tabs)
+        has_flags[has_flags] = tabs[cut_tab[has_flags]] < ends[has_flags]
+        cuts[has_flags] = tabs[cut_tab[has_flags]]
+
+        # keep [start, cut) of each sample line, plus a separator
+        marks = numpy.zeros(len(buf) + 1, dtype=numpy.int8)
+        marks[starts] = 1
+        marks[cuts] = -1
+        keep = numpy.cumsum(marks[:-1], dtype=numpy.int8).view(numpy.bool_)
+        data = buf.copy()
+        data[cuts] = _SPACE
+        keep[cuts] = True
+        data[(data == _TAB) | (data == _CR)] = _SPACE
+
+        # a missing value is a lone '.', i.e., not next to a digit
+        dots = numpy.flatnonzero(keep & (data == _DOT))
+        if len(dots):
+            before = data[dots - 1]
+            after = data[dots + 1]
+            missing = dots[(before == _SPACE) & (after == _SPACE)]
+        else:
+            missing = dots
+        data = data[keep]
+        if len(missing):
+            # positions in the kept bytes, then '.' -> 'nan'
+            missing = numpy.searchsorted(numpy.flatnonzero(keep), missing)
+            data[missing] = ord('n')
+            data = numpy.insert(data, numpy.repeat(missing, 2),
+                                numpy.tile(numpy.frombuffer(b'na',
+                                                            numpy.uint8),
+                                           len(missing)))
+
+        values = numpy.fromstring(data.tobytes(), sep=' ')
+        if len(values) != len(starts)*n_columns:
+            raise ValueError('Expected %d columns in the samples: %s' %
+                             (n_columns, ', '.join(self.columns)))
+        self.sample_chunks.append(values.reshape(-1, n_columns))
+
+    def _event(self, line):
+        """ Decode one event or header line"""
+
+        words = line.split()
+        kind = words[0]
+
+        if kind == 'MSG':
+            parts = line.split(None, 2)
+            text = parts[2].rstrip() if len(parts) > 2 else ''
+            self.messages.append((int(parts[1]), text))
+        elif kind == 'EFIX':
+            self.fixations.append((words[1],) + _floats(words[2:8]))
+        elif kind == 'ESACC':
+            self.saccades.append((words[1],) + _floats(words[2:11]))
+        elif kind == 'EBLINK':
+            self.blinks.append((words[1],) + _floats(words[2:5]))
+        elif kind == 'START':
+            self.starts.append(int(words[1]))
+        elif kind == 'END':
+            self.ends.append(int(words[1]))
+        elif kind == 'INPUT':
+            self.inputs.append((int(words[1]), int(words[2])))
+        elif kind == 'SAMPLES':
+            columns = sample_columns(line)
+            if self.columns is not None and columns != self.columns:
+                raise ValueError('The sample columns change within the '
+                                 'file: %s' % line.strip())
+            self.columns = columns
+            if 'RATE' in words:
+                self.rate = float(words[words.index('RATE') + 1])
+
+    def result(self):
+        """ Gather the chunks into an ASCData"""
+
+        data = ASCData()
+        data.n_lines = self.n_lines
+        data.rate = self.rate
+        data.sample_columns = list(self.columns or [])
+
+        if self.sample_chunks:
+            samples = numpy.concatenate(self.sample_chunks)
+        else:
+            samples = numpy.zeros((0, len(data.sample_columns)))
+        for i, name in enumerate(data.sample_columns):
+            # copy each column so it is contiguous
+            column = numpy.ascontiguousarray(samples[:, i])
+            if name in ('time', 'input'):
+                column = column.astype(numpy.int64)
+            data.samples[name] = column
+
+        data.messages = {
+            'time': numpy.array([m[0] for m in self.messages],
+                                dtype=numpy.int64),
+            'text': numpy.array([m[1] for m in self.messages],
+                                dtype=object)}
+        data.fixations = _event_columns(self.fixations, FIXATION_COLUMNS)
+        data.saccades = _event_columns(self.saccades, SACCADE_COLUMNS)
+        data.blinks = _event_columns(self.blinks, BLINK_COLUMNS)
+        data.recordings = {
+            'start': numpy.array(self.starts, dtype=numpy.int64),
+            'end': numpy.array(self.ends, dtype=numpy.int64)}
+        data.inputs = {
+            'time': numpy.array([i[0] for i in self.inputs],
+                                dtype=numpy.int64),
+            'value': numpy.array([i[1] for i in self.inputs],
+                                 dtype=numpy.int64)}
+
+        return data
+
+
+def _floats(words):
+    """ Event values, '.' is a missing value"""
+
+    return tuple(float('nan') if w == '.' else float(w) for w in words)
+
+
+def _event_columns(events, columns):
+    """ List of (eye, values...) tuples -> dict of column arrays"""
+
+    table = {'eye': numpy.array([e[0] for e in events], dtype='<U1')}
+    values = numpy.array([e[1:] for e in events], dtype=numpy.float64)
+    values = values.reshape(len(events), len(columns))
+    for i, name in enumerate(columns):
+        column = numpy.ascontiguousarray(values[:, i])
+        if name in ('start', 'end', 'duration'):
+            column = column.astype(numpy.int64)
+        table[name] = column
+
+    return table
+
+
+def read_asc(asc_file, chunk_size=16*1024**2):
+    """ Read an ASC file
+
+    Parameters:
+        asc_file--path of the file
+        chunk_size--number of bytes read at once
+    Returns an ASCData
+    """
+
+    reader = _Reader()
+    rest = b''
+    with open(asc_file, 'rb') as f:
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            block = rest + block
+            # parse whole lines only, the rest goes with the next chunk
+            last_nl = block.rfind(b'\n')
+            if last_nl < 0:
+                rest = block
+                continue
+            rest = block[last_nl + 1:]
+            reader.feed(block[:last_nl + 1])
+    if rest.strip():
+        reader.feed(rest + b'\n')
+
+    return reader.result()
+
+
+def _read_asc_by_line(asc_file):
+    """ Reference reader, one line at a time, used by the benchmark to
+    check read_asc() and to compare the speed. Returns the samples as an
+    array (one row per sample)"""
+
+    rows = []
+    with open(asc_file) as f:
+        for line in f:
+            if not line[:1].isdigit():
+                continue
+            fields = line.split('\t')
+            row = []
+            for field in fields:
+                field = field.strip()
+                if field == '.':
+                    row.append(float('nan'))
+                else:
+                    try:
+                        row.append(float(field))
+                    except ValueError:
+                        # the flags
+                        break
+            rows.append(row)
+
+    return numpy.array(rows)
+
+
+def main():
+    """ Read an ASC file and print the throughput of read_asc(), e.g.,
+    python asc.py Resultats_Pupillometry/<session>/<session>.asc"""
+
+    import argparse
+    import os
+    import time
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('asc_file')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of reads, the best time is reported')
+    parser.add_argument('--chunk-size', type=int, default=16*1024**2,
+                        help='bytes read at once')
+    args = parser.parse_args()
+
+    size = os.path.getsize(args.asc_file)
+
+    best = None
+    for _ in range(args.repeat):
+        t_start = time.perf_counter()
+        data = read_asc(args.asc_file, args.chunk_size)
+        duration = time.perf_counter() - t_start
+        best = duration if best is None else min(best, duration)
+
+    t_start = time.perf_counter()
+    reference = _read_asc_by_line(args.asc_file)
+    by_line = time.perf_counter() - t_start
+
+    samples = numpy.column_stack([data.samples[c]
+                                  for c in data.sample_columns])
+    same = samples.shape == reference.shape and \
+        numpy.allclose(samples, reference, equal_nan=True)
+
+    print('%s: %d lines, %.1f MB, %d samples (%s) at %s Hz' %
+          (os.path.basename(args.asc_file), data.n_lines, size/1024.0**2,
+           len(data), ', '.join(data.sample_columns), data.rate))
+    print('  %d messages, %d fixations, %d saccades, %d blinks, '
+          '%d recordings, %d inputs' %
+          (len(data.messages['time']), len(data.fixations['eye']),
+           len(data.saccades['eye']), len(data.blinks['eye']),
+           len(data.recordings['start']), len(data.inputs['time'])))
+    print('  read_asc:   %7.1f ms, %10.0f lines/s, %6.1f MB/s' %
+          (best*1000, data.n_lines/best, size/1024.0**2/best))
+    print('  line by line: %5.1f ms, %10.0f lines/s (samples only)' %
+          (by_line*1000, data.n_lines/by_line))
+    print('  same samples as the line by line reader: %s' % same)
+
+
+if __name__ == '__main__':
+    main()
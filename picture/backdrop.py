@@ -0,0 +1,380 @@
+#########################################
+#
+# Pupillometry - Host PC backdrop preparation
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# The Host PC expects the pixels passed to bitmapBackdrop() as a list of
+# lines, line = [pix1, ... pixW], pix = (R, G, B). Building that list with a
+# nested comprehension over img.load() costs one Python call per pixel, i.e.
+# ~4M calls per image at 2560x1600. The helpers below do the conversion on
+# NumPy arrays instead, so the only Python-level loop left runs once per line.
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import time
+import threading
+import numpy
+from collections import OrderedDict, namedtuple
+import pylink
+from PIL import Image
+
+
+def load_rgb(image_file, size):
+    """ Read an image with PIL, resize it and return an (H, W, 3) uint8 array
+
+    Parameters:
+        image_file--path to the image on the local drive
+        size--(width, height) of the backdrop, usually the screen resolution
+    """
+
+    im = Image.open(image_file).convert('RGB')
+    if im.size != tuple(size):
+        im = im.resize(tuple(size))
+
+    return numpy.asarray(im, dtype=numpy.uint8)
+
+
+def cache_path(image_file, size, cache_dir, ext):
+    """ Path of a file cached for an image at a given size, e.g.,
+    cache_dir/2560x1600/img_1.png-<mtime>-<file size>.npy; the folder is
+    created if needed"""
+
+    res_dir = os.path.join(cache_dir, '%dx%d' % tuple(size))
+    if not os.path.exists(res_dir):
+        os.makedirs(res_dir)
+
+    st = os.stat(image_file)
+    cache_name = '%s-%d-%d%s' % (os.path.basename(image_file),
+                                 int(st.st_mtime*1000), st.st_size, ext)
+
+    return os.path.join(res_dir, cache_name)
+
+
+def load_rgb_cached(image_file, size, cache_dir):
+    """ Same as load_rgb(), but keep the resized array in an .npy file so
+    the next sessions memory-map it instead of decoding the image again
+
+    The cached files are stored per screen resolution, e.g.,
+    cache_dir/2560x1600/img_1.png-<mtime>-<file size>.npy. Editing or
+    replacing the source image changes the stamp, the stale file is then
+    removed and the image converted again. A stale file that is still memory-mapped can not be
+    removed on Windows, it is left for the next session.
+    """
+
+    width, height = size
+    cache_file = cache_path(image_file, size, cache_dir, '.npy')
+    res_dir, cache_name = os.path.split(cache_file)
+    prefix = os.path.basename(image_file) + '-'
+    stamp = os.path.splitext(cache_name)[0]
+
+    if os.path.exists(cache_file):
+        try:
+            rgb = numpy.load(cache_file, mmap_mode='r')
+            if rgb.shape == (height, width, 3):
+                return rgb
+        except (IOError, ValueError) as error:
+            print('WARNING: ignoring backdrop cache %s (%s)' %
+                  (cache_file, error))
+
+    # drop the files cached for older versions of the image
+    for f in os.listdir(res_dir):
+        if f.startswith(prefix) and os.path.splitext(f)[0] != stamp:
+            try:
+                os.remove(os.path.join(res_dir, f))
+            except OSError as error:
+                print('WARNING: stale backdrop cache %s not removed (%s)' %
+                      (f, error))
+
+    rgb = load_rgb(image_file, size)
+    # write to a temporary file first, a session killed halfway through
+    # should not leave a truncated cache behind
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        numpy.save(f, rgb)
+    os.replace(tmp_file, cache_file)
+
+    return rgb
+
+
+def host_pixels(rgb):
+    """ Convert an (H, W, 3) uint8 array into the format expected by
+    bitmapBackdrop(), i.e., [line1, ...lineH], line = [pix1,...pixW],
+    pix=(R,G,B)
+
+    Our stimuli only use a handful of colors, so we pack each pixel into a
+    24bit number, build one (R,G,B) tuple per distinct color and map every
+    line onto those shared tuples. This keeps the conversion in NumPy and
+    C-level map() calls, and the resulting list is a few bytes per pixel.
+    """
+
+    rgb = numpy.ascontiguousarray(rgb, dtype=numpy.uint8)
+
+    # 24bit color number for each pixel, e.g. RGB (1, 64, 127) -> 82047
+    codes = (rgb[..., 0].astype(numpy.uint32) << 16) | \
+            (rgb[..., 1].astype(numpy.uint32) << 8) | \
+            rgb[..., 2]
+
+    # index of each pixel in the list of distinct colors, a dense 24bit
+    # lookup table is much cheaper than sorting the 4M codes with unique()
+    present = numpy.zeros(1 << 24, dtype=bool)
+    present[codes.ravel()] = True
+    colors = numpy.flatnonzero(present)
+    lut = numpy.zeros(1 << 24, dtype=numpy.int32)
+    lut[colors] = numpy.arange(len(colors), dtype=numpy.int32)
+    index = lut[codes]
+
+    palette = [(int(c >> 16), int((c >> 8) & 0xFF), int(c & 0xFF))
+               for c in colors]
+    lookup = palette.__getitem__
+
+    return [list(map(lookup, line))
+            for line in index.tolist()]
+
+
+def send_backdrop(el_tracker, pixels, width, height,
+                  options=pylink.BX_MAXCONTRAST):
+    """ Send the converted pixels to the Host PC as a full screen backdrop
+
+    Parameters:
+        el_tracker--the active EyeLink connection
+        pixels--lines of (R,G,B) tuples returned by host_pixels()
+        width, height--size of the backdrop in pixels
+        options--bitmapBackdrop drawing options
+    """
+
+    # parameters: width, height, pixel, crop_x, crop_y,
+    #             crop_width, crop_height, x, y on the Host, drawing options
+    el_tracker.bitmapBackdrop(width, height, pixels,
+                              0, 0, width, height,
+                              0, 0, options)
+
+
+# A cached backdrop, the resized RGB array, the converted Host pixels and
+# the memory it takes
+Backdrop = namedtuple('Backdrop', ['rgb', 'pixels', 'nbytes'])
+
+
+def send_entry(el_tracker, entry, options=pylink.BX_MAXCONTRAST):
+    """ Send a Backdrop returned by BackdropCache.get() to the Host PC"""
+
+    height, width = entry.rgb.shape[:2]
+    send_backdrop(el_tracker, entry.pixels, width, height, options)
+
+
+class BackdropCache(object):
+    """ Session-level cache of converted backdrops
+
+    Each entry is keyed by (path, mtime, width, height), so an image edited
+    on disk during a session is converted again. The least recently used
+    entries are dropped once the cache grows over max_bytes."""
+
+    def __init__(self, size, max_bytes=512*1024*1024, cache_dir=None):
+        """ Parameters:
+            size--(width, height) of the backdrops, usually the screen size
+            max_bytes--approximate memory budget of the cache
+            cache_dir--folder to keep the resized images between sessions,
+                       see load_rgb_cached(), None to disable
+        """
+
+        self._width, self._height = size
+        self._max_bytes = max_bytes
+        self._cache_dir = cache_dir
+        self._nbytes = 0
+        self._entries = OrderedDict()
+        # entries may be added from a prefetch thread, see prefetch.py
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, image_file):
+        """ Cache key of an image at the current backdrop size"""
+
+        return (os.path.abspath(image_file), os.path.getmtime(image_file),
+                self._width, self._height)
+
+    def get(self, image_file):
+        """ Return the Backdrop of an image, converting it if needed"""
+
+        key = self._key(image_file)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+            # drop the older versions of the image, their arrays may map
+            # the .npy files load_rgb_cached() is about to remove
+            for old_key in [k for k in self._entries
+                            if k[0] == key[0] and k[1] != key[1]]:
+                self._nbytes -= self._entries.pop(old_key).nbytes
+
+        # convert outside of the lock, lookups from the other thread
+        # should not wait for the conversion
+        if self._cache_dir is None:
+            rgb = load_rgb(image_file, (self._width, self._height))
+        else:
+            rgb = load_rgb_cached(image_file, (self._width, self._height),
+                                  self._cache_dir)
+        # lines are lists of pointers to the shared color tuples
+        nbytes = rgb.nbytes + self._height*(self._width*8 + 56)
+        entry = Backdrop(rgb, host_pixels(rgb), nbytes)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._nbytes += entry.nbytes
+            self._entries.move_to_end(key)
+            # evict the least recently used backdrops, keep this one
+            while self._nbytes > self._max_bytes and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self._nbytes -= old.nbytes
+
+        return entry
+
+    def send(self, el_tracker, image_file, options=pylink.BX_MAXCONTRAST):
+        """ Send a cached backdrop to the Host PC"""
+
+        send_entry(el_tracker, self.get(image_file), options)
+
+
+class BackdropScheduler(object):
+    """ Send the Host backdrop of a trial from the main thread, while the
+    tracker is offline
+
+    Sending the perception, rest and baseline backdrops in a row before the
+    trial only left the last one on the Host screen, so a trial now sends
+    one backdrop. Pylink calls are not thread safe, and a bitmap transfer
+    over the link in the middle of a recording delays the messages sent at
+    the same time. The conversion of the pixels, the slow part, is done
+    ahead in the prefetch thread (see BackdropCache and prefetch.py); only
+    the transfer is left here, on the main thread, before startRecording().
+    Each transfer is logged with its size and duration, see transfers.
+    """
+
+    def __init__(self, el_tracker, options=pylink.BX_MAXCONTRAST):
+        """ Parameters:
+            el_tracker--the active EyeLink connection
+            options--bitmapBackdrop drawing options
+        """
+
+        self._tracker = el_tracker
+        self._options = options
+        # (phase, bytes, seconds) of each completed transfer
+        self.transfers = []
+
+    def show(self, phase, entry, commands=()):
+        """ Send a backdrop to the Host, the tracker must be offline
+
+        Parameters:
+            phase--name of the phase, used in the log
+            entry--a Backdrop returned by BackdropCache.get()
+            commands--Host drawing commands sent after the backdrop, e.g.,
+                      landmarks that the backdrop would otherwise cover
+        Returns True if the backdrop was sent; a failed transfer is logged,
+        the trial can go on without its backdrop
+        """
+
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError('Host backdrops must be sent from the main '
+                               'thread')
+        if self._tracker.isRecording() == pylink.TRIAL_OK:
+            print('WARNING: backdrop %s not sent, the tracker is recording'
+                  % phase)
+            return False
+
+        try:
+            self._transfer(phase, entry, commands)
+        except Exception as error:
+            print('ERROR: backdrop %s not sent (%s)' % (phase, error))
+            return False
+
+        return True
+
+    def _transfer(self, phase, entry, commands):
+        """ Send one backdrop and log the bytes and time it took"""
+
+        t_start = time.perf_counter()
+        send_entry(self._tracker, entry, self._options)
+        for cmd in commands:
+            self._tracker.sendCommand(cmd)
+        duration = time.perf_counter() - t_start
+
+        nbytes = entry.rgb.nbytes
+        self.transfers.append((phase, nbytes, duration))
+        print('Backdrop %s: %d bytes in %.1f ms' %
+              (phase, nbytes, duration*1000))
+
+
+def legacy_host_pixels(image_file, size):
+    """ The per-pixel conversion we used in run_trial, kept for the
+    benchmark below"""
+
+    width, height = size
+    im = Image.open(image_file).resize((width, height))
+    img_pixels = im.load()
+
+    return [[img_pixels[i, j] for i in range(width)]
+            for j in range(height)]
+
+
+def main():
+    """ Benchmark the backdrop preparation of a V4.py trial (perception,
+    rest and baseline images), before and after vectorizing. The transfer
+    times are only measured when a tracker address is given.
+
+    usage: python backdrop.py [--size W H] [--host 100.1.1.1]"""
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--size', type=int, nargs=2, default=[2560, 1600],
+                        metavar=('W', 'H'), help='screen resolution')
+    parser.add_argument('--host', default=None,
+                        help='EyeLink Host PC address, to time the transfers')
+    args = parser.parse_args()
+    size = tuple(args.size)
+
+    trial_images = [os.path.join('images', f)
+                    for f in ['img_1.png', 'repos.png', 'base.png']]
+
+    t_start = time.perf_counter()
+    for image_file in trial_images:
+        legacy_host_pixels(image_file, size)
+    t_legacy = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    for image_file in trial_images:
+        host_pixels(load_rgb(image_file, size))
+    t_bulk = time.perf_counter() - t_start
+
+    print('Backdrop preparation per trial at %dx%d (%d images)' %
+          (size[0], size[1], len(trial_images)))
+    print('  per-pixel comprehension: %7.1f ms' % (t_legacy*1000))
+    print('  vectorized:              %7.1f ms' % (t_bulk*1000))
+
+    if args.host is None:
+        print('  no transfer times without a tracker, use --host')
+        return
+
+    el_tracker = pylink.EyeLink(args.host)
+    el_tracker.setOfflineMode()
+    cache = BackdropCache(size)
+    scheduler = BackdropScheduler(el_tracker)
+    for image_file in trial_images:
+        scheduler.show(os.path.basename(image_file), cache.get(image_file))
+    t_transfer = sum(t for _, _, t in scheduler.transfers)
+    print('  transfer:                %7.1f ms' % (t_transfer*1000))
+    el_tracker.close()
+
+
+if __name__ == '__main__':
+    # the images folder is relative to the script folder
+    script_path = os.path.dirname(sys.argv[0])
+    if len(script_path) != 0:
+        os.chdir(script_path)
+    main()
@@ -0,0 +1,308 @@
+#########################################
+#
+# Pupillometry - blink detection and interpolation
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# Remove the blinks from the pupil trace of a whole session at once:
+#
+# 1. the samples of the EBLINK events of the tracker, and the samples where
+#    the pupil is lost (pupil size 0 or missing), are marked as missing;
+# 2. the samples where the pupil size changes faster than a threshold are
+#    marked as well: the pupil shrinks and grows very fast as the eyelid
+#    covers it at the edges of a blink, before and after the tracker loses
+#    it. The threshold is the median plus n_mad times the median absolute
+#    deviation of the speed over the session (Kret & Sjak-Shie, 2019);
+# 3. every gap is padded on both sides, and gaps closer than merge_gap are
+#    merged into one;
+# 4. the gaps are filled, linearly between the samples on both sides of the
+#    gap, or with a cubic through 4 points (Mathot, 2013): the two samples
+#    around the gap and two samples one gap length further away.
+#
+# Everything runs on the whole sample arrays with NumPy, the only Python
+# loops are over the parameters. The gaps never cross the start or end of a
+# recording (the samples are only recorded during the trials); a gap at the
+# start or end of a recording, or longer than max_gap, stays NaN.
+#
+#     data = edf.read_edf(edf_file)
+#     missing = blinks.detect_blinks(data)
+#     pupil = blinks.interpolate_blinks(data, missing, kind='cubic')
+
+from __future__ import division
+from __future__ import print_function
+
+import numpy
+
+
+def detect_blinks(data, pad_before=50, pad_after=100, merge_gap=50,
+                  n_mad=16, use_events=True):
+    """ Mark the samples of blinks and pupil dropouts
+
+    Parameters:
+        data--an asc.ASCData, from asc.read_asc() or edf.read_edf()
+        pad_before--ms marked before each gap
+        pad_after--ms marked after each gap
+        merge_gap--gaps closer than this (ms) are merged
+        n_mad--speed threshold in median absolute deviations above the
+               median speed, no speed detection if None
+        use_events--mark the samples of the EBLINK events
+    Returns a boolean array, True for the samples to interpolate
+    """
+
+    time = data.samples['time']
+    pupil = data.samples['pupil']
+    n = len(time)
+    ms = (data.rate or 1000.0)/1000.0
+
+    # lost pupil
+    missing = ~(pupil > 0)
+
+    # tracker blinks, start and end included
+    if use_events and len(data.blinks.get('start', [])):
+        starts = numpy.searchsorted(time, data.blinks['start'])
+        ends = numpy.searchsorted(time, data.blinks['end'], side='right')
+        missing |= _mask(starts, ends, n)
+
+    # pupil size speed, the largest of the speeds to the previous and next
+    # samples, NaN next to a missing sample
+    if n_mad is not None and n > 1:
+        valid_pupil = numpy.where(missing, numpy.nan, pupil)
+        speed = numpy.abs(numpy.diff(valid_pupil))/numpy.diff(time)
+        speed = numpy.fmax(numpy.append(speed, numpy.nan),
+                           numpy.insert(speed, 0, numpy.nan))
+        if numpy.any(numpy.isfinite(speed)):
+            median = numpy.nanmedian(speed)
+            mad = numpy.nanmedian(numpy.abs(speed - median))
+            missing |= speed > median + n_mad*mad
+
+    segment = _segments(time, data.rate)
+    first, last = _segment_bounds(segment)
+    starts, ends = _runs(missing, first)
+
+    # padding, within the recording
+    starts = numpy.maximum(starts - int(round(pad_before*ms)),
+                           first[segment[starts]])
+    ends = numpy.minimum(ends + int(round(pad_after*ms)),
+                         last[segment[ends - 1]])
+
+    # merge the close gaps of a same recording: mark the samples between
+    # them as well
+    if len(starts) > 1 and merge_gap:
+        next_starts = starts[1:]
+        previous_ends = ends[:-1]
+        close = (next_starts - previous_ends < merge_gap*ms) & \
+            (segment[next_starts] == segment[previous_ends - 1])
+        starts = numpy.concatenate([starts, previous_ends[close]])
+        ends = numpy.concatenate([ends, next_starts[close]])
+
+    return _mask(starts, ends, n)
+
+
+def interpolate_blinks(data, missing, kind='linear', max_gap=None,
+                       column='pupil'):
+    """ Fill the gaps of a sample column
+
+    Parameters:
+        data--an asc.ASCData
+        missing--boolean array of the samples to fill, see detect_blinks()
+        kind--'linear' or 'cubic'
+        max_gap--gaps longer than this (ms) are not filled, no limit if None
+        column--the sample column, e.g., 'pupil', 'x'
+    Returns a new float array, NaN where a gap could not be filled
+    """
+
+    if kind not in ('linear', 'cubic'):
+        raise ValueError('Unknown interpolation: %s' % kind)
+
+    time = data.samples['time']
+    values = data.samples[column].astype(numpy.float64)
+    values[missing] = numpy.nan
+    n = len(time)
+    segment = _segments(time, data.rate)
+    starts, ends = _runs(missing, _segment_bounds(segment)[0])
+    if len(starts) == 0:
+        return values
+
+    # the samples on both sides of each gap, in the same recording
+    left = starts - 1
+    right = ends
+    fill = (left >= 0) & (right < n)
+    left = numpy.clip(left, 0, n - 1)
+    right = numpy.clip(right, 0, n - 1)
+    fill &= (segment[left] == segment[right])
+    fill &= numpy.isfinite(values[left]) & numpy.isfinite(values[right])
+    if max_gap is not None:
+        fill &= (time[right] - time[left]) <= max_gap + \
+            2*1000.0/(data.rate or 1000.0)
+    starts, ends, left, right = (starts[fill], ends[fill], left[fill],
+                                 right[fill])
+
+    # gap of each sample to fill
+    samples = numpy.flatnonzero(_mask(starts, ends, n))
+    gap = numpy.searchsorted(starts, samples, side='right') - 1
+    t = time[samples].astype(numpy.float64)
+    t_left = time[left].astype(numpy.float64)
+    t_right = time[right].astype(numpy.float64)
+
+    if kind == 'cubic':
+        # two more points, one gap length before and after the gap
+        length = t_right - t_left
+        outer_left = numpy.searchsorted(time, t_left - length)
+        outer_right = numpy.searchsorted(time, t_right + length)
+        outer_right = numpy.minimum(outer_right, n - 1)
+        cubic = (segment[outer_left] == segment[left]) & \
+            (segment[outer_right] == segment[right]) & \
+            ~missing[outer_left] & ~missing[outer_right] & \
+            (outer_left < left) & (outer_right > right)
+        points = [(time[outer_left].astype(numpy.float64), outer_left),
+                  (t_left, left), (t_right, right),
+                  (time[outer_right].astype(numpy.float64), outer_right)]
+
+        # Lagrange polynomial through the 4 points of the gap of each
+        # sample; the gaps without the outer points get NaN here, they are
+        # filled linearly below
+        filled = numpy.zeros(len(samples))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for i, (t_i, index_i) in enumerate(points):
+                weight = numpy.ones(len(samples))
+                for j, (t_j, _) in enumerate(points):
+                    if i != j:
+                        weight *= (t - t_j[gap])/(t_i[gap] - t_j[gap])
+                filled += weight*values[index_i][gap]
+        linear = ~cubic[gap]
+    else:
+        filled = numpy.zeros(len(samples))
+        linear = numpy.ones(len(samples), dtype=numpy.bool_)
+
+    # linear, also for the gaps without the outer points of the cubic
+    fraction = (t[linear] - t_left[gap[linear]]) / \
+        (t_right[gap[linear]] - t_left[gap[linear]])
+    filled[linear] = values[left][gap[linear]] + fraction * \
+        (values[right][gap[linear]] - values[left][gap[linear]])
+
+    values[samples] = filled
+    return values
+
+
+def gaps(missing, data=None):
+    """ Gaps of a mask of missing samples
+
+    Parameters:
+        missing--boolean array, see detect_blinks()
+        data--an asc.ASCData, to return times instead of sample offsets
+    Returns the arrays (starts, ends), [start, end) sample offsets, or
+    start and end times (end included) if data is given; with data, a gap
+    over the end of a recording and the start of the next is split in two
+    """
+
+    if data is None:
+        return _runs(missing)
+    time = data.samples['time']
+    starts, ends = _runs(missing,
+                         _segment_bounds(_segments(time, data.rate))[0])
+    return time[starts], time[ends - 1]
+
+
+def _runs(mask, breaks=None):
+    """ [start, end) of the runs of True of a boolean array
+
+    Parameters:
+        mask--the boolean array
+        breaks--offsets where a run is split in two, e.g., the first sample
+                of each recording
+    """
+
+    edges = numpy.diff(numpy.concatenate(([0], mask.view(numpy.int8),
+                                          [0])))
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    if breaks is not None and len(starts):
+        breaks = breaks[(breaks > 0) & (breaks < len(mask))]
+        breaks = breaks[mask[breaks] & mask[breaks - 1]]
+        starts = numpy.sort(numpy.concatenate((starts, breaks)))
+        ends = numpy.sort(numpy.concatenate((ends, breaks)))
+
+    return starts, ends
+
+
+def _mask(starts, ends, n):
+    """ Boolean array of n items, True in the [start, end) runs, which may
+    overlap"""
+
+    if len(starts) == 0:
+        return numpy.zeros(n, dtype=numpy.bool_)
+    marks = numpy.bincount(starts, minlength=n + 1) - \
+        numpy.bincount(ends, minlength=n + 1)
+    return numpy.cumsum(marks[:n]) > 0
+
+
+def _segments(time, rate=None):
+    """ Recording of each sample: a new recording starts where the time
+    jumps by more than 2 sample intervals"""
+
+    interval = 1000.0/(rate or 1000.0)
+    jumps = numpy.diff(time) > 2*interval
+    return numpy.concatenate(([0], numpy.cumsum(jumps)))
+
+
+def _segment_bounds(segment):
+    """ First sample and end (exclusive) of each recording"""
+
+    first = numpy.flatnonzero(numpy.diff(segment, prepend=-1))
+    last = numpy.append(first[1:], len(segment))
+    return first, last
+
+
+def main():
+    """ Detect and interpolate the blinks of EDF or ASC files, and print
+    the throughput, e.g., python blinks.py
+    Resultats_Pupillometry/*/*.EDF --repeat 200"""
+
+    import argparse
+    import os
+    import time
+    import asc
+    import edf
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('data_files', nargs='+', help='EDF or ASC files')
+    parser.add_argument('--repeat', type=int, default=100,
+                        help='number of times each file is processed')
+    parser.add_argument('--kind', default='cubic',
+                        choices=['linear', 'cubic'])
+    args = parser.parse_args()
+
+    sessions = []
+    for data_file in args.data_files:
+        if os.path.splitext(data_file)[1].lower() == '.edf':
+            sessions.append(edf.read_edf(data_file))
+        else:
+            sessions.append(asc.read_asc(data_file))
+
+    for data_file, data in zip(args.data_files, sessions):
+        missing = detect_blinks(data)
+        pupil = interpolate_blinks(data, missing, args.kind)
+        n_events = len(data.blinks['start'])
+        print('%s: %d gaps (%d EBLINK), %.1f%% of the samples, %d left '
+              'NaN' % (os.path.basename(data_file), len(gaps(missing)[0]),
+                       n_events, 100.0*missing.mean(),
+                       numpy.isnan(pupil).sum()))
+
+    n_samples = 0
+    t_start = time.perf_counter()
+    for _ in range(args.repeat):
+        for data in sessions:
+            missing = detect_blinks(data)
+            interpolate_blinks(data, missing, args.kind)
+            n_samples += len(data)
+    duration = time.perf_counter() - t_start
+    n_sessions = args.repeat*len(sessions)
+    print('%d sessions in %.2f s: %.1f ms per session, %.1f M samples/s' %
+          (n_sessions, duration, duration/n_sessions*1000,
+           n_samples/duration/1e6))
+
+
+if __name__ == '__main__':
+    main()
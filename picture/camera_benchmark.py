@@ -0,0 +1,110 @@
+#########################################
+#
+# Pupillometry - camera image conversion benchmark
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# Compare the per-frame cost of converting the camera image sent by Pylink
+# (pallete indices, line by line) into RGBX pixels: the per-pixel loop the
+# CoreGraphics library used to run, and the NumPy lookup table it uses now.
+#
+# usage: python camera_benchmark.py [width height]
+
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import array
+import numpy
+from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
+
+
+def legacy_palette(r, g, b):
+    """ The pallete as built by the previous set_image_palette()"""
+
+    sz = len(r)
+    i = 0
+    pal = []
+    while i < sz:
+        rf = int(b[i])
+        gf = int(g[i])
+        bf = int(r[i])
+        pal.append((rf << 16) | (gf << 8) | (bf))
+        i = i+1
+
+    return pal
+
+
+def legacy_frame(pal, lines, width):
+    """ The previous draw_image_line(), one lookup per pixel"""
+
+    imagebuffer = array.array('I')
+    for buff in lines:
+        for i in range(width):
+            try:
+                imagebuffer.append(pal[buff[i]])
+            except:
+                pass
+
+    return imagebuffer.tobytes()
+
+
+def numpy_frame(pal, lines, width, frame):
+    """ The current draw_image_line(), one take() per line"""
+
+    for line, buff in enumerate(lines):
+        indices = numpy.frombuffer(buff, dtype=numpy.uint8, count=width)
+        pal.take(indices, mode='clip', out=frame[line])
+
+    return frame.tobytes()
+
+
+def main():
+    if len(sys.argv) == 3:
+        width, height = int(sys.argv[1]), int(sys.argv[2])
+    else:
+        width, height = 384, 320
+    n_frames = 20
+
+    # a gray pallete and random camera frames
+    r = g = b = list(range(256))
+    rng = numpy.random.default_rng(0)
+    lines = [rng.integers(0, 256, width, dtype=numpy.uint8).tobytes()
+             for _ in range(height)]
+
+    t_start = time.perf_counter()
+    for _ in range(n_frames):
+        old_pal = legacy_palette(r, g, b)
+    t_old_pal = (time.perf_counter() - t_start)/n_frames
+
+    t_start = time.perf_counter()
+    for _ in range(n_frames):
+        new_pal = EyeLinkCoreGraphicsPsychoPy._build_palette(r, g, b)
+    t_new_pal = (time.perf_counter() - t_start)/n_frames
+
+    t_start = time.perf_counter()
+    for _ in range(n_frames):
+        old_bytes = legacy_frame(old_pal, lines, width)
+    t_old = (time.perf_counter() - t_start)/n_frames
+
+    frame = numpy.zeros((height, width), dtype='<u4')
+    t_start = time.perf_counter()
+    for _ in range(n_frames):
+        new_bytes = numpy_frame(new_pal, lines, width, frame)
+    t_new = (time.perf_counter() - t_start)/n_frames
+
+    assert old_bytes == new_bytes
+
+    print('Camera image conversion, %dx%d, mean of %d frames' %
+          (width, height, n_frames))
+    print('  pallete, while loop:      %8.3f ms' % (t_old_pal*1000))
+    print('  pallete, NumPy:           %8.3f ms' % (t_new_pal*1000))
+    print('  frame, per-pixel lookup:  %8.3f ms' % (t_old*1000))
+    print('  frame, NumPy take:        %8.3f ms' % (t_new*1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,434 @@
+#########################################
+#
+# Pupillometry - EDF file reader
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# Read the EDF files downloaded from the Host PC directly, without the
+# edf2asc conversion. The result is the same asc.ASCData as asc.read_asc()
+# gives for the converted file, e.g.
+#
+#     data = edf.read_edf('Resultats_Pupillometry/<session>/<session>.EDF')
+#
+# The layout below was worked out on our files (EyeLink CL, v5.15, EDF
+# version "EYELINK II 1") and checked against their ASC conversion, see
+# main(). After a text preamble ending with "ENDP:\n", the file is a stream
+# of records, all values big-endian:
+#
+# - samples: 2 bytes of sample flags, the lowest bit is always set, then the
+#   time (4 bytes with the SAMPLE_TIMESTAMP flag, else 1 byte added to the
+#   time of the previous sample), then one field per flag, in the order of
+#   _SAMPLE_FIELDS. Positions and resolutions are 16 bit integers in tenths
+#   of a pixel, -32768 marks a missing value.
+# - events: 1 byte of event type (low 5 bits) and eye (bits 6-7), 1 flag
+#   byte (lowest bit clear), then tagged fields up to a 0 byte. The low 5
+#   bits of a tag tell its size: 0x1e is a string (2 bytes of length, then
+#   the null terminated text), 0x10-0x1f are 2 bytes, 0x00-0x0f 4 bytes.
+#   The top 3 bits tell which value it is (start, end, average, ...).
+#
+# Only monocular recordings are handled, we have no binocular file to check
+# the order of the two eyes against.
+#
+# edf2asc sorts the messages by time, and merges the blinks of a same
+# saccade into one blink and marks all the samples of the merged blink as
+# missing (with a pupil size of 0). The same is done here so the two readers
+# agree.
+
+from __future__ import division
+from __future__ import print_function
+
+import struct
+import numpy
+import asc
+
+
+# event types
+STARTBLINK = 3
+ENDBLINK = 4
+STARTSACC = 5
+ENDSACC = 6
+STARTFIX = 7
+ENDFIX = 8
+STARTSAMPLES = 15
+ENDSAMPLES = 16
+MESSAGEEVENT = 24
+BUTTONEVENT = 25
+INPUTEVENT = 28
+
+# event tags
+_TAG_START = 0x21
+_TAG_END = 0x41
+_TAG_START_GAZE = 0x2a
+_TAG_END_GAZE = 0x4a
+_TAG_AVG_GAZE = 0x6a
+_TAG_START_RES = 0x2b
+_TAG_END_RES = 0x4b
+_TAG_AVG_PUPIL = 0x72
+_TAG_PEAK_VEL = 0x93
+_TAG_INPUT = 0x55
+_TAG_TEXT = 0x5e
+_TAG_SAMPLE_RATE = 0x41
+_TAG_SAMPLE_FLAGS = 0xb4
+
+# sample flags
+SAMPLE_LEFT = 0x8000
+SAMPLE_RIGHT = 0x4000
+SAMPLE_TIMESTAMP = 0x2000
+# (flag, field names, size in bytes), in the order of the sample record
+_SAMPLE_FIELDS = [(0x1000, ('px', 'py'), 4),
+                  (0x0800, ('hx', 'hy'), 4),
+                  (0x0400, ('x', 'y'), 4),
+                  (0x0200, ('res_x', 'res_y'), 4),
+                  (0x0100, ('pupil',), 2),
+                  (0x0080, ('status',), 2),
+                  (0x0040, ('input',), 2),
+                  (0x0020, ('buttons',), 2)]
+_SAMPLE_UNKNOWN = 0x001e
+
+MISSING = -32768
+
+
+def _sample_layout(flags):
+    """ Offsets of the fields of a sample record, from the start of its
+    data, and the size of the data"""
+
+    if flags & SAMPLE_LEFT and flags & SAMPLE_RIGHT:
+        raise ValueError('Binocular samples are not supported')
+    if flags & _SAMPLE_UNKNOWN:
+        raise ValueError('Unknown sample flags 0x%04x' % flags)
+
+    offsets = {}
+    size = 0
+    for flag, names, field_size in _SAMPLE_FIELDS:
+        if flags & flag:
+            for i, name in enumerate(names):
+                offsets[name] = size + 2*i
+            size += field_size
+
+    return offsets, size
+
+
+def _be16(buf, offsets):
+    """ Signed big-endian 16 bit integers at the given offsets"""
+
+    return ((buf[offsets].astype(numpy.int32) << 8) |
+            buf[offsets + 1]).astype(numpy.int16)
+
+
+def _pair(value):
+    """ Split a 4 byte tag value into two 16 bit values, in tenths"""
+
+    x = (value >> 16) & 0xffff
+    y = value & 0xffff
+    x = x - 0x10000 if x & 0x8000 else x
+    y = y - 0x10000 if y & 0x8000 else y
+    return (numpy.nan if x == MISSING else x/10.0,
+            numpy.nan if y == MISSING else y/10.0)
+
+
+def read_edf(edf_file):
+    """ Read an EDF file
+
+    Parameters:
+        edf_file--path of the file
+    Returns an asc.ASCData, with the samples and events edf2asc would
+    write with its default options
+    """
+
+    with open(edf_file, 'rb') as f:
+        data = f.read()
+    if not data.startswith(b'SR_RESEARCH'):
+        raise ValueError('%s is not an EDF file' % edf_file)
+    pos = data.index(b'ENDP:\n') + 6
+    end = len(data)
+
+    # record positions of the samples, by sample flags
+    sample_pos = {}
+    events = []
+    layouts = {}
+    unpack_int = struct.Struct('>i').unpack_from
+    unpack_short = struct.Struct('>h').unpack_from
+    unpack_ushort = struct.Struct('>H').unpack_from
+
+    while pos < end:
+        b0 = data[pos]
+        b1 = data[pos + 1] if pos + 1 < end else 0
+        if b1 & 1:
+            # sample
+            flags = (b0 << 8) | b1
+            layout = layouts.get(flags)
+            if layout is None:
+                layout = layouts[flags] = _sample_layout(flags)
+            sample_pos.setdefault(flags, []).append(pos)
+            pos += (6 if flags & SAMPLE_TIMESTAMP else 3) + layout[1]
+            continue
+
+        if b0 == 0:
+            # end of the file
+            break
+
+        # event, (type, eye, {tag: value})
+        fields = {}
+        p = pos + 2
+        while p < end and data[p] != 0:
+            tag = data[p]
+            kind = tag & 0x1f
+            if kind == 0x1e:
+                n = unpack_ushort(data, p + 1)[0]
+                fields[tag] = data[p + 3:p + 3 + n]
+                p += 3 + n
+            elif kind & 0x10:
+                fields[tag] = unpack_short(data, p + 1)[0]
+                p += 3
+            else:
+                fields[tag] = unpack_int(data, p + 1)[0]
+                p += 5
+        events.append((b0 & 0x1f, 'R' if b0 & 0x40 else 'L', fields))
+        pos = p + 1
+
+    reader = _EventReader()
+    for event in events:
+        reader.event(*event)
+    result = reader.result()
+    _read_samples(data, sample_pos, layouts, result)
+    _merge_blinks(result)
+
+    return result
+
+
+def _read_samples(data, sample_pos, layouts, result):
+    """ Decode all the sample records at once"""
+
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    columns = None
+    all_pos = []
+    values = {}
+    for flags, positions in sample_pos.items():
+        offsets, size = layouts[flags]
+        names = ['time', 'x', 'y', 'pupil']
+        if 'input' in offsets:
+            names.append('input')
+        if columns is None:
+            columns = names
+        elif names != columns:
+            raise ValueError('The sample fields change within the file')
+
+        positions = numpy.array(positions, dtype=numpy.int64)
+        all_pos.append(positions)
+        start = positions + (6 if flags & SAMPLE_TIMESTAMP else 3)
+
+        if flags & SAMPLE_TIMESTAMP:
+            # full time stamp
+            time = ((buf[positions + 2].astype(numpy.int64) << 24) |
+                    (buf[positions + 3].astype(numpy.int64) << 16) |
+                    (buf[positions + 4].astype(numpy.int64) << 8) |
+                    buf[positions + 5])
+            full = numpy.ones(len(positions), dtype=numpy.bool_)
+        else:
+            # delta to the previous sample
+            time = buf[positions + 2].astype(numpy.int64)
+            full = numpy.zeros(len(positions), dtype=numpy.bool_)
+        values.setdefault('_full', []).append(full)
+        values.setdefault('time', []).append(time)
+
+        for name in columns[1:]:
+            column = _be16(buf, start + offsets[name])
+            if name in ('x', 'y'):
+                column = column.astype(numpy.float64)
+                column[column == MISSING] = numpy.nan
+                column /= 10.0
+            elif name == 'input':
+                column = column.astype(numpy.int64) & 0xffff
+            else:
+                column = column.astype(numpy.float64)
+            values.setdefault(name, []).append(column)
+
+    if columns is None:
+        return
+
+    # back in file order
+    order = numpy.argsort(numpy.concatenate(all_pos), kind='stable')
+    full = numpy.concatenate(values.pop('_full'))[order]
+    for name in columns:
+        values[name] = numpy.concatenate(values[name])[order]
+
+    # time of the delta samples: time of the last full sample plus the
+    # deltas since
+    time = values['time']
+    deltas = numpy.where(full, 0, time)
+    total = numpy.cumsum(deltas)
+    last_full = numpy.maximum.accumulate(
+        numpy.where(full, numpy.arange(len(time)), 0))
+    if not full[0]:
+        raise ValueError('The first sample has no time stamp')
+    values['time'] = time[last_full] + total - total[last_full]
+
+    result.sample_columns = columns
+    result.samples = values
+
+
+class _EventReader(object):
+    """ Gather the events into the column lists of asc._Reader"""
+
+    def __init__(self):
+        self.reader = asc._Reader()
+        self.sample_flags = None
+
+    def event(self, kind, eye, fields):
+        reader = self.reader
+
+        if kind == MESSAGEEVENT:
+            text = fields.get(_TAG_TEXT, b'').rstrip(b'\x00')
+            text = text.decode('latin-1')
+            # edf2asc writes the first line of the message on the MSG line
+            text = text.split('\n')[0].rstrip()
+            reader.messages.append((fields[_TAG_START], text))
+        elif kind == ENDFIX:
+            x, y = _pair(fields[_TAG_AVG_GAZE])
+            reader.fixations.append(
+                (eye, fields[_TAG_START], fields[_TAG_END],
+                 fields[_TAG_END] - fields[_TAG_START] + 1,
+                 x, y, float(fields[_TAG_AVG_PUPIL])))
+        elif kind == ENDSACC:
+            start_x, start_y = _pair(fields[_TAG_START_GAZE])
+            end_x, end_y = _pair(fields[_TAG_END_GAZE])
+            # amplitude in degrees, with the mean resolution (pixels per
+            # degree) of the start and end of the saccade
+            start_rx, start_ry = _pair(fields[_TAG_START_RES])
+            end_rx, end_ry = _pair(fields[_TAG_END_RES])
+            amplitude = numpy.hypot((end_x - start_x)/(start_rx + end_rx)*2,
+                                    (end_y - start_y)/(start_ry + end_ry)*2)
+            reader.saccades.append(
+                (eye, fields[_TAG_START], fields[_TAG_END],
+                 fields[_TAG_END] - fields[_TAG_START] + 1,
+                 start_x, start_y, end_x, end_y, amplitude,
+                 fields[_TAG_PEAK_VEL]/10.0))
+        elif kind == ENDBLINK:
+            reader.blinks.append(
+                (eye, fields[_TAG_START], fields[_TAG_END],
+                 fields[_TAG_END] - fields[_TAG_START] + 1))
+        elif kind == STARTSAMPLES:
+            reader.starts.append(fields[_TAG_START])
+            # sample rate, 16.16 fixed point
+            reader.rate = fields[_TAG_SAMPLE_RATE]/65536.0
+        elif kind == ENDSAMPLES:
+            reader.ends.append(fields[_TAG_END])
+        elif kind == INPUTEVENT:
+            reader.inputs.append((fields[_TAG_START],
+                                  fields[_TAG_INPUT] & 0xffff))
+
+    def result(self):
+        # edf2asc writes the messages in time order, the tracker stores the
+        # !MODE RECORD message before the recording settings of the same
+        # START, with an earlier time
+        self.reader.messages.sort(key=lambda message: message[0])
+        return self.reader.result()
+
+
+def _merge_blinks(data):
+    """ Merge the blinks of a same saccade and mark their samples as
+    missing, as edf2asc does"""
+
+    blinks = data.blinks
+    if len(blinks['start']) == 0:
+        return
+
+    # two blinks belong to the same saccade if no fixation starts in
+    # between
+    fix_starts = numpy.sort(data.fixations['start'])
+    merged = []
+    for i in range(len(blinks['start'])):
+        eye = blinks['eye'][i]
+        start = int(blinks['start'][i])
+        end = int(blinks['end'][i])
+        if merged and merged[-1][0] == eye:
+            previous_end = merged[-1][2]
+            first = numpy.searchsorted(fix_starts, previous_end)
+            if first == len(fix_starts) or fix_starts[first] > start:
+                merged[-1][2] = end
+                continue
+        merged.append([eye, start, end])
+
+    data.blinks = asc._event_columns(
+        [(eye, start, end, end - start + 1) for eye, start, end in merged],
+        asc.BLINK_COLUMNS)
+
+    if 'time' not in data.samples:
+        return
+    time = data.samples['time']
+    first = numpy.searchsorted(time, data.blinks['start'])
+    last = numpy.searchsorted(time, data.blinks['end'], side='right')
+    for i, j in zip(first, last):
+        data.samples['x'][i:j] = numpy.nan
+        data.samples['y'][i:j] = numpy.nan
+        data.samples['pupil'][i:j] = 0
+
+
+def main():
+    """ Read an EDF file, compare it with its ASC conversion and print the
+    read times, e.g., python edf.py Resultats_Pupillometry/<session>/
+    <session>.EDF"""
+
+    import argparse
+    import os
+    import time
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('edf_file')
+    parser.add_argument('asc_file', nargs='?',
+                        help='the ASC conversion, next to the EDF file by '
+                             'default')
+    args = parser.parse_args()
+    asc_file = args.asc_file or os.path.splitext(args.edf_file)[0] + '.asc'
+
+    t_start = time.perf_counter()
+    data = read_edf(args.edf_file)
+    edf_time = time.perf_counter() - t_start
+    t_start = time.perf_counter()
+    reference = asc.read_asc(asc_file)
+    asc_time = time.perf_counter() - t_start
+
+    print('%s: %d samples (%s) at %s Hz' %
+          (os.path.basename(args.edf_file), len(data),
+           ', '.join(data.sample_columns), data.rate))
+    print('  read_edf %.1f ms, read_asc %.1f ms' %
+          (edf_time*1000, asc_time*1000))
+
+    # (table, column, tolerance), the ASC file has 2 decimals for the
+    # amplitude and none for the peak velocity
+    checks = [('samples', c, 0) for c in reference.sample_columns]
+    checks += [('messages', 'time', 0), ('messages', 'text', None),
+               ('fixations', 'eye', None), ('saccades', 'eye', None),
+               ('blinks', 'eye', None), ('recordings', 'start', 0),
+               ('recordings', 'end', 0), ('inputs', 'time', 0),
+               ('inputs', 'value', 0)]
+    checks += [('fixations', c, 0) for c in asc.FIXATION_COLUMNS]
+    checks += [('saccades', c, 0) for c in asc.SACCADE_COLUMNS[:-2]]
+    checks += [('saccades', 'amplitude', 0.005 + 1e-9),
+               ('saccades', 'peak_velocity', 0.5 + 1e-9)]
+    checks += [('blinks', c, 0) for c in asc.BLINK_COLUMNS]
+
+    n_failed = 0
+    for table, column, tolerance in checks:
+        ours = getattr(data, table).get(column)
+        theirs = getattr(reference, table).get(column)
+        if ours is None or len(ours) != len(theirs):
+            same = False
+        elif tolerance is None:
+            same = bool(numpy.all(ours == theirs))
+        else:
+            same = bool(numpy.allclose(ours, theirs, rtol=0,
+                                       atol=tolerance + 1e-6,
+                                       equal_nan=True))
+        if not same:
+            n_failed += 1
+        print('  %-10s %-14s %s' % (table, column, 'ok' if same else
+                                    'DIFFERENT'))
+    print('  %s' % ('same data as the ASC file' if n_failed == 0 else
+                    '%d columns differ' % n_failed))
+
+
+if __name__ == '__main__':
+    main()
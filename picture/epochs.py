@@ -0,0 +1,268 @@
+#########################################
+#
+# Pupillometry - trial and phase index
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# Cut the samples of a session into trials and trial phases, from the
+# messages run_trial() sends to the tracker:
+#
+#     TRIALID n               start of the trial (before the drift check)
+#     <phase>_onset           onset flip of a phase, e.g., base_onset,
+#                             image_onset, repos_onset
+#     fin phase ...           the phase ran for its whole duration
+#     key_pressed             the phase was ended with the SPACEBAR
+#     blank_screen            end of the last phase
+#     TRIAL_RESULT r          end of the trial
+#
+# TrialIndex goes once through the messages and turns every boundary into a
+# sample offset with a binary search in the sample times, so an epoch is
+# then a slice of the sample arrays (a view, nothing is copied), e.g.
+#
+#     data = edf.read_edf(edf_file)
+#     index = epochs.TrialIndex(data)
+#     for row in range(len(index)):
+#         pupil = index.epoch(row, 'image')
+#
+# Trials are referred to by their row, their position in the file: the
+# TRIALID is not unique in a session, the test trial and the first trial
+# are both TRIALID 1 and a trial that is run again keeps its TRIALID.
+#
+# A phase is named after its onset message without '_onset'; when the same
+# onset message is used by several phases of a trial, the next ones are
+# numbered, e.g., the two baselines are 'base' and 'base2'.
+
+from __future__ import division
+from __future__ import print_function
+
+import numpy
+
+
+# messages ending a phase before the next onset
+PHASE_END_MESSAGES = ('fin phase', 'key_pressed', 'trial_skipped_by_user',
+                      'terminated_by_user', 'tracker_disconnected')
+# result of a trial that has no TRIAL_RESULT message (pylink.TRIAL_ERROR)
+NO_RESULT = -1
+
+
+class TrialIndex(object):
+    """ Sample offsets of the trials and phases of a session
+
+    Attributes:
+        trials--dict of arrays, one row per trial: 'trial_id', 'result',
+                'start_time', 'end_time' (TRIALID and TRIAL_RESULT times),
+                'start', 'end' (sample offsets)
+        phases--dict of arrays, one row per phase: 'trial' (row of the
+                trial), 'name', 'start_time', 'end_time', 'start', 'end',
+                'end_msg' (message that ended the phase)
+    The sample offsets delimit [start, end) in the sample arrays.
+    """
+
+    def __init__(self, data):
+        """ Parameters:
+            data--an asc.ASCData, from asc.read_asc() or edf.read_edf()
+        """
+
+        self.data = data
+        trials = []
+        phases = []
+        trial = None
+        phase = None
+
+        for time, text in zip(data.messages['time'], data.messages['text']):
+            time = int(time)
+            if text.startswith('TRIALID'):
+                if trial is not None:
+                    # the previous trial was not closed
+                    phase = _close_phase(phase, phases, time, text)
+                    trial[2] = time
+                    trials.append(trial)
+                trial = [_last_number(text), NO_RESULT, None, time]
+                trial_names = {}
+                continue
+            if trial is None:
+                continue
+
+            if text.endswith('_onset'):
+                phase = _close_phase(phase, phases, time, text)
+                name = text[:-len('_onset')]
+                trial_names[name] = trial_names.get(name, 0) + 1
+                if trial_names[name] > 1:
+                    name += str(trial_names[name])
+                phase = [len(trials), name, time]
+            elif text.startswith(PHASE_END_MESSAGES) or \
+                    text == 'blank_screen':
+                phase = _close_phase(phase, phases, time, text)
+            elif text.startswith('TRIAL_RESULT'):
+                phase = _close_phase(phase, phases, time, text)
+                trial[1] = _last_number(text)
+                trial[2] = time
+                trials.append(trial)
+                trial = None
+
+        if trial is not None:
+            # the file ends in the middle of a trial
+            end_time = int(data.messages['time'][-1])
+            if len(data.recordings.get('end', [])):
+                end_time = max(end_time, int(data.recordings['end'][-1]))
+            if len(data.samples.get('time', [])):
+                end_time = max(end_time, int(data.samples['time'][-1]) + 1)
+            _close_phase(phase, phases, end_time, '')
+            trial[2] = end_time
+            trials.append(trial)
+
+        self.trials = {
+            'trial_id': numpy.array([t[0] for t in trials], dtype=numpy.int64),
+            'result': numpy.array([t[1] for t in trials], dtype=numpy.int64),
+            'start_time': numpy.array([t[3] for t in trials],
+                                      dtype=numpy.int64),
+            'end_time': numpy.array([t[2] for t in trials],
+                                    dtype=numpy.int64)}
+        self.phases = {
+            'trial': numpy.array([p[0] for p in phases], dtype=numpy.int64),
+            'name': numpy.array([p[1] for p in phases], dtype=object),
+            'start_time': numpy.array([p[2] for p in phases],
+                                      dtype=numpy.int64),
+            'end_time': numpy.array([p[3] for p in phases],
+                                    dtype=numpy.int64),
+            'end_msg': numpy.array([p[4] for p in phases], dtype=object)}
+
+        # all the boundaries at once
+        time = data.samples.get('time', numpy.zeros(0, dtype=numpy.int64))
+        for table in (self.trials, self.phases):
+            table['start'] = numpy.searchsorted(time, table['start_time'])
+            table['end'] = numpy.searchsorted(time, table['end_time'])
+
+        # (trial row, phase name) -> phase row
+        self._phase_rows = {}
+        for row, (trial_row, name) in enumerate(zip(self.phases['trial'],
+                                                    self.phases['name'])):
+            self._phase_rows[(int(trial_row), name)] = row
+
+    def __len__(self):
+        return len(self.trials['trial_id'])
+
+    @property
+    def phase_names(self):
+        """ Names of the phases, in their order in the trials"""
+
+        names = []
+        for name in self.phases['name']:
+            if name not in names:
+                names.append(name)
+        return names
+
+    def rows(self, trial_id):
+        """ Rows of the trials with a TRIALID"""
+
+        return numpy.flatnonzero(self.trials['trial_id'] == trial_id)
+
+    def span(self, row, phase=None):
+        """ slice of the samples of a trial, or of one of its phases
+
+        Parameters:
+            row--row of the trial
+            phase--name of the phase, the whole trial if None
+        Raises KeyError if the trial has no such phase
+        """
+
+        if phase is None:
+            return slice(self.trials['start'][row], self.trials['end'][row])
+        i = self._phase_rows[(row, phase)]
+        return slice(self.phases['start'][i], self.phases['end'][i])
+
+    def epoch(self, row, phase=None, column='pupil'):
+        """ Samples of a trial or phase, a view of the sample array
+
+        Parameters:
+            row--row of the trial
+            phase--name of the phase, the whole trial if None
+            column--the sample column, e.g., 'pupil', 'x', 'time'
+        """
+
+        return self.data.samples[column][self.span(row, phase)]
+
+    def epochs(self, phase, column='pupil'):
+        """ Samples of a phase in every trial that has it
+
+        Returns (rows of the trials, list of views of the sample array)
+        """
+
+        selected = numpy.flatnonzero(self.phases['name'] == phase)
+        samples = self.data.samples[column]
+        views = [samples[start:end] for start, end in
+                 zip(self.phases['start'][selected],
+                     self.phases['end'][selected])]
+
+        return self.phases['trial'][selected], views
+
+
+def _last_number(text):
+    """ Number at the end of a TRIALID or TRIAL_RESULT message"""
+
+    try:
+        return int(text.split()[-1])
+    except (IndexError, ValueError):
+        return NO_RESULT
+
+
+def _close_phase(phase, phases, time, text):
+    """ End the current phase, if any, at a message. Returns None"""
+
+    if phase is not None:
+        phases.append(phase + [time, text])
+    return None
+
+
+def main():
+    """ Index the trials of an EDF or ASC file and print the duration and
+    number of samples of each phase, e.g., python epochs.py
+    Resultats_Pupillometry/<session>/<session>.EDF"""
+
+    import argparse
+    import os
+    import time
+    import asc
+    import edf
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('data_file', help='EDF or ASC file')
+    args = parser.parse_args()
+
+    if os.path.splitext(args.data_file)[1].lower() == '.edf':
+        data = edf.read_edf(args.data_file)
+    else:
+        data = asc.read_asc(args.data_file)
+
+    t_start = time.perf_counter()
+    index = TrialIndex(data)
+    duration = time.perf_counter() - t_start
+    print('%d trials, %d phases indexed in %.2f ms' %
+          (len(index), len(index.phases['name']), duration*1000))
+
+    for row in range(len(index)):
+        print('trial %d (TRIALID %d, result %d): %d samples' %
+              (row, index.trials['trial_id'][row],
+               index.trials['result'][row], len(index.epoch(row))))
+        for i in numpy.flatnonzero(index.phases['trial'] == row):
+            print('    %-8s %6d ms %6d samples  %s' %
+                  (index.phases['name'][i],
+                   index.phases['end_time'][i] -
+                   index.phases['start_time'][i],
+                   index.phases['end'][i] - index.phases['start'][i],
+                   index.phases['end_msg'][i]))
+
+    # slicing cost
+    t_start = time.perf_counter()
+    n = 0
+    for _ in range(1000):
+        for name in index.phase_names:
+            n += len(index.epochs(name)[1])
+    duration = time.perf_counter() - t_start
+    print('%.2f us per epoch' % (duration/max(n, 1)*1e6))
+
+
+if __name__ == '__main__':
+    main()
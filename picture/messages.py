@@ -0,0 +1,98 @@
+#########################################
+#
+# Pupillometry - deferred EyeLink messages
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# Only a few messages need to be sent at the time of the event they mark,
+# e.g., the phase onsets, which are sent from win.callOnFlip(). The Data
+# Viewer messages of a phase (!V CLEAR, IMGLOAD, IAREA) only need the right
+# timestamp, so they are queued and sent together when nothing critical is
+# going on.
+#
+# A message may start with a time offset in ms, the tracker then logs it at
+# the current time minus the offset, see the EyeLink Programmer's Guide:
+#     el_tracker.sendMessage('%d %s' % (offset, msg))
+# Each queued message keeps the time of its event, the offset is computed
+# when the queue is flushed.
+
+from __future__ import division
+from __future__ import print_function
+
+from psychopy import core
+
+
+class MessageQueue(object):
+    """ Messages waiting to be sent to the tracker with a time offset
+
+    Usage:
+        msg_queue.defer_all(['!V CLEAR 116 116 116', ...], flip_time)
+        ...
+        msg_queue.flush()  # later, e.g., right after the onset flip
+    """
+
+    def __init__(self, el_tracker):
+        """ Parameters:
+            el_tracker--the active EyeLink connection
+        """
+
+        self._el_tracker = el_tracker
+        # (event time, message)
+        self._pending = []
+        # number of messages sent and largest offset (ms) so far
+        self.sent = 0
+        self.max_offset = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def defer(self, msg, event_time=None):
+        """ Queue a message
+
+        Parameters:
+            msg--the message text, without offset
+            event_time--time of the event the message belongs to
+                        (core.getTime()), now if None
+        """
+
+        if event_time is None:
+            event_time = core.getTime()
+        self._pending.append((event_time, msg))
+
+    def defer_all(self, msgs, event_time=None):
+        """ Queue several messages logged at the same time"""
+
+        if event_time is None:
+            event_time = core.getTime()
+        for msg in msgs:
+            self._pending.append((event_time, msg))
+
+    def flush(self):
+        """ Send all the queued messages, each one stamped back to the time
+        of its event. Returns the number of messages sent"""
+
+        if not self._pending:
+            return 0
+
+        el_tracker = self._el_tracker
+        now = core.getTime()
+        for event_time, msg in self._pending:
+            offset = int(round((now - event_time)*1000))
+            if offset > 0:
+                el_tracker.sendMessage('%d %s' % (offset, msg))
+                self.max_offset = max(self.max_offset, offset)
+            else:
+                el_tracker.sendMessage(msg)
+
+        n_sent = len(self._pending)
+        self.sent += n_sent
+        self._pending = []
+
+        return n_sent
+
+    def clear(self):
+        """ Drop the queued messages, e.g., when a trial is aborted"""
+
+        self._pending = []
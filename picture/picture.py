@@ -17,6 +17,7 @@ import random
 import time
 import sys
 from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
+import stimuli
 from psychopy import visual, core, event, monitors, gui
 from PIL import Image  # for preparing the Host backdrop image
 from string import ascii_letters, digits
@@ -259,6 +260,15 @@ genv.setCalibrationSounds('', '', '')
 # Request Pylink to use the PsychoPy window we opened above for calibration
 pylink.openGraphicsEx(genv) 
 
+# All the images used in the task
+task_images = set(['base.png', 'repos.png'] + [pic for cond, pic in trials])
+
+# Build the ImageStim of every image once, before the first trial, instead of
+# uploading new textures to the graphics card at the start of each trial
+stim_registry = stimuli.StimulusRegistry(win, (scn_width, scn_height))
+stim_registry.preload([os.path.join('images', f) for f in task_images])
+stim_registry.report()
+
 
 # define a few helper functions for trial handling
 
@@ -411,18 +421,11 @@ def run_trial(trial_pars, trial_index):
     # unpacking the trial parameters
     cond, pic = trial_pars
 
-    # load the image to display, here we stretch the image to fill full screen
-    img = visual.ImageStim(win,
-                           image=os.path.join('images', pic),
-                           size=(scn_width, scn_height))
-
-    repos= visual.ImageStim(win,
-                           image=os.path.join('images', 'repos.png'),
-                           size=(scn_width, scn_height))
-    
-    base = visual.ImageStim(win,
-                           image=os.path.join('images', 'base.png'),
-                           size=(scn_width, scn_height))
+    # the images to display, stretched to fill full screen; the ImageStim
+    # objects were built before the first trial, see stim_registry
+    img = stim_registry.get(os.path.join('images', pic))
+    repos = stim_registry.get(os.path.join('images', 'repos.png'))
+    base = stim_registry.get(os.path.join('images', 'base.png'))
 
     # get a reference to the currently active EyeLink connection
     el_tracker = pylink.getEYELINK()
@@ -0,0 +1,88 @@
+#########################################
+#
+# Pupillometry - background trial preparation
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# While trial N is recording, a worker thread prepares what trial N+1 needs
+# (e.g., the converted Host backdrops), so run_trial only consumes objects
+# that are ready and the ITI is left with the drift-check.
+#
+# The worker must not touch the PsychoPy window or the tracker connection:
+# OpenGL textures belong to the main thread and Pylink calls are not thread
+# safe. Keep those in run_trial and only prepare plain data here.
+
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import threading
+import queue
+
+
+class TrialPrefetcher(object):
+    """ Iterate over a list of trials, the next trials being prepared in a
+    background thread
+
+    Usage:
+        for trial_pars, prepared in TrialPrefetcher(prepare, trial_list):
+            run_trial(trial_pars, trial_index, prepared)
+    """
+
+    def __init__(self, prepare, trial_list, depth=1):
+        """ Parameters:
+            prepare--function called with the trial parameters in the worker
+                     thread, its return value is handed over to run_trial
+            trial_list--the trials to run, in order
+            depth--number of trials prepared ahead of the current one
+        """
+
+        self._prepare = prepare
+        self._trials = list(trial_list)
+        self._ready = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run,
+                                        name='TrialPrefetcher')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _run(self):
+        """ Worker thread, prepare the trials one after the other"""
+
+        for trial_pars in self._trials:
+            if self._stop.is_set():
+                return
+            try:
+                item = (trial_pars, self._prepare(trial_pars), None)
+            except Exception:
+                # hand the error over to the main thread
+                item = (trial_pars, None, sys.exc_info()[1])
+            self._put(item)
+
+    def _put(self, item):
+        """ Wait for a free slot in the queue, unless we are stopped"""
+
+        while not self._stop.is_set():
+            try:
+                self._ready.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        for _ in range(len(self._trials)):
+            trial_pars, prepared, error = self._ready.get()
+            if error is not None:
+                self.stop()
+                raise error
+            yield trial_pars, prepared
+
+    def __len__(self):
+        return len(self._trials)
+
+    def stop(self):
+        """ Stop preparing trials, e.g., when the task is terminated"""
+
+        self._stop.set()
@@ -0,0 +1,292 @@
+#########################################
+#
+# Pupillometry - session checkpoint
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# The checkpoint file of a session (checkpoint.json, in the session folder)
+# is written after each trial. It holds the trial order of the session, the
+# trials still to run and the EDF files recorded so far, so a session that
+# was interrupted (tracker disconnected, task terminated) can be resumed
+# instead of being started over. A trial leaves the list of trials to run
+# once it is completed or skipped by the user; a trial that failed (e.g.,
+# the tracker stopped recording) stays in it and is run again when the
+# session is resumed.
+#
+# A resumed session records into a new EDF file on the Host, one segment per
+# run of the script: test1003.EDF, then e.g. test_k2p.EDF, test_07x.EDF, ...
+# The Host only accepts 8 characters, so a segment keeps the first 4
+# characters of the file name followed by '_' and a 3 character code. The
+# code is drawn again until the name differs from every EDF file name used by
+# the sessions in the results folder, so a segment never overwrites the file
+# of another participant on the Host. The local copies are named after the
+# session, e.g., test1003_2022_03_10_15_04.EDF, then ..._1.EDF, ...
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import zlib
+import pylink
+from trialplan import Trial
+
+
+CHECKPOINT_FILE = 'checkpoint.json'
+# '_%Y_%m_%d_%H_%M' added to the EDF file name for the session folders
+SESSION_TIME_LENGTH = 17
+
+_BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def segment_edf_name(edf_fname, segment, taken=(), max_attempts=1000):
+    """ Name of the EDF file of a segment on the Host, 8 characters at
+    most, without the extension
+
+    Parameters:
+        edf_fname--the EDF file name of the session, used for segment 0
+        segment--number of the segment
+        taken--EDF file names the segment must not use, compared without
+               case, see edf_names()
+    Raises ValueError if no free name was found
+    """
+
+    if segment == 0:
+        return edf_fname
+
+    taken = set(name.upper() for name in taken)
+    taken.add(edf_fname.upper())
+    for attempt in range(max_attempts):
+        # a 3 character code, always the same for a given session, segment
+        # and attempt
+        number = zlib.crc32(('%s/%d/%d' % (edf_fname, segment, attempt))
+                            .encode('utf-8')) % 36**3
+        code = ''
+        for _ in range(3):
+            number, digit = divmod(number, 36)
+            code = _BASE36[digit] + code
+        name = '%s_%s' % (edf_fname[:4], code)
+        if name.upper() not in taken:
+            return name
+
+    raise ValueError('No free EDF file name for segment %d of %s' %
+                     (segment, edf_fname))
+
+
+def edf_names(results_folder):
+    """ EDF file names used by the sessions of a results folder, i.e., the
+    file name given at the start of each session and the Host file of each
+    segment, without extension
+
+    Returns (session names, segment names), two sets of upper case names
+    """
+
+    sessions = set()
+    segments = set()
+    if not os.path.isdir(results_folder):
+        return sessions, segments
+
+    for folder in os.listdir(results_folder):
+        path = os.path.join(results_folder, folder, CHECKPOINT_FILE)
+        if not os.path.exists(path):
+            # sessions recorded before the checkpoints, named after the
+            # EDF file name and the session start time
+            if len(folder) > SESSION_TIME_LENGTH:
+                sessions.add(folder[:-SESSION_TIME_LENGTH].upper())
+            continue
+        try:
+            checkpoint = SessionCheckpoint.load(path)
+        except (IOError, OSError, ValueError, KeyError) as error:
+            print('WARNING: can not read %s: %s' % (path, error))
+            continue
+        sessions.add(checkpoint.edf_fname.upper())
+        for host_edf, local_edf, first_trial in checkpoint.segments:
+            name = os.path.splitext(host_edf)[0].upper()
+            if name != checkpoint.edf_fname.upper():
+                segments.add(name)
+
+    return sessions, segments
+
+
+def find_unfinished(results_folder, edf_fname):
+    """ Return the checkpoint file of the latest unfinished session of a
+    participant, None if there is none
+
+    Parameters:
+        results_folder--the folder holding the session folders
+        edf_fname--the EDF file name given at the start of the sessions
+    """
+
+    if not os.path.isdir(results_folder):
+        return None
+
+    # the session folders are named edf_fname + '_%Y_%m_%d_%H_%M', so the
+    # latest session comes last in alphabetical order
+    prefix = edf_fname + '_'
+    for folder in sorted(os.listdir(results_folder), reverse=True):
+        if not folder.startswith(prefix):
+            continue
+        path = os.path.join(results_folder, folder, CHECKPOINT_FILE)
+        if not os.path.exists(path):
+            continue
+        try:
+            checkpoint = SessionCheckpoint.load(path)
+        except (IOError, OSError, ValueError, KeyError) as error:
+            print('WARNING: can not read %s: %s' % (path, error))
+            continue
+        if checkpoint.edf_fname == edf_fname and not checkpoint.finished:
+            return path
+
+    return None
+
+
+class SessionCheckpoint(object):
+    """ Progress of a session, saved after each trial
+
+    Usage:
+        checkpoint = SessionCheckpoint.create(path, edf_fname, identifier,
+                                              plan)
+        host_edf, local_edf = checkpoint.start_segment()
+        for position in checkpoint.pending:
+            status = run_trial(...)
+            checkpoint.trial_done(position, status)
+        if not checkpoint.pending:
+            checkpoint.finish()
+    """
+
+    def __init__(self, path, state):
+        """ Parameters:
+            path--the checkpoint file
+            state--the content of the checkpoint file, see create()
+        """
+
+        self.path = path
+        self._state = state
+        self.plan = [Trial(*trial) for trial in state['plan']]
+
+    @classmethod
+    def create(cls, path, edf_fname, session_identifier, plan):
+        """ Start a new session
+
+        Parameters:
+            path--the checkpoint file, in the session folder
+            edf_fname--the EDF file name on the Host, without extension
+            session_identifier--name of the session, used for the local
+                                EDF files
+            plan--the trials of the session, in order
+        """
+
+        state = {'edf_fname': edf_fname,
+                 'session_identifier': session_identifier,
+                 'plan': [list(trial) for trial in plan],
+                 'pending': list(range(len(plan))),
+                 'results': [],
+                 'segments': [],
+                 'finished': False}
+        checkpoint = cls(path, state)
+        checkpoint.save()
+
+        return checkpoint
+
+    @classmethod
+    def load(cls, path):
+        """ Read the checkpoint of a session"""
+
+        with open(path) as f:
+            state = json.load(f)
+
+        return cls(path, state)
+
+    @property
+    def edf_fname(self):
+        return self._state['edf_fname']
+
+    @property
+    def session_identifier(self):
+        return self._state['session_identifier']
+
+    @property
+    def pending(self):
+        """ Positions in the plan of the trials still to run, in order; the
+        failed trials come back in their place"""
+        return list(self._state['pending'])
+
+    @property
+    def next_trial(self):
+        """ Position in the plan of the next trial to run"""
+        pending = self._state['pending']
+        return pending[0] if pending else len(self.plan)
+
+    @property
+    def n_done(self):
+        """ Number of trials completed or skipped"""
+        return len(self.plan) - len(self._state['pending'])
+
+    @property
+    def segments(self):
+        """ (Host EDF file, local EDF file, first trial) of each segment"""
+        return self._state['segments']
+
+    @property
+    def finished(self):
+        return self._state['finished']
+
+    def start_segment(self, taken=()):
+        """ Start recording a new EDF segment
+
+        Parameters:
+            taken--EDF file names used by the other sessions, see
+                   edf_names(); the segment file name is none of them
+        Returns the EDF file name on the Host and the name of its local copy
+        """
+
+        segment = len(self._state['segments'])
+        # the names of the previous segments of this session are taken too
+        taken = set(taken)
+        taken.update(os.path.splitext(host_edf)[0]
+                     for host_edf, _, _ in self._state['segments'])
+        host_edf = segment_edf_name(self.edf_fname, segment, taken) + '.EDF'
+        local_edf = self.session_identifier
+        if segment > 0:
+            local_edf += '_%d' % segment
+        local_edf += '.EDF'
+
+        self._state['segments'].append([host_edf, local_edf,
+                                        self.next_trial])
+        self.save()
+
+        return host_edf, local_edf
+
+    def trial_done(self, position, status):
+        """ Record the result of a trial, after its TRIAL_RESULT message
+
+        Parameters:
+            position--position of the trial in the plan
+            status--the value returned by run_trial; a trial completed or
+                    skipped by the user is done, any other status keeps it
+                    in pending, to be run again when the session is resumed
+        """
+
+        self._state['results'].append([position, status])
+        if status in (pylink.TRIAL_OK, pylink.SKIP_TRIAL) and \
+                position in self._state['pending']:
+            self._state['pending'].remove(position)
+        self.save()
+
+    def finish(self):
+        """ Mark the session as complete, it won't be offered for resume,
+        even if some trials failed"""
+
+        self._state['finished'] = True
+        self.save()
+
+    def save(self):
+        """ Write the checkpoint file; the file is replaced in one step so
+        a crash never leaves a truncated checkpoint"""
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._state, f, indent=1)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,375 @@
+#########################################
+#
+# Pupillometry - smoke run of the task
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# Run V4.py from start to end without a tracker, a screen or a participant:
+# Pylink, PsychoPy and the calibration graphics are replaced by stubs that
+# log the tracker calls, every phase is ended by a SPACEBAR press and every
+# question is answered with key 1. The task runs in a copy of the script
+# folder, so no session is added to Resultats_Pupillometry.
+#
+# The task runs twice: the tracker gets disconnected in the middle of the
+# first run, so the remaining trials fail and the EDF is not downloaded, and
+# the second run resumes the session. The run checks that the whole session
+# went through: the test trial and all the trials of the plan ended with
+# TRIAL_RESULT 0, the checkpoint is marked finished, the EDF of the second
+# segment was downloaded and the missing EDF of the first one was reported.
+# Pylink is not thread safe, so it also checks that the tracker was only
+# called from the main thread (but for receiveDataFile, see transfer.py),
+# that no backdrop was sent during a recording and that the Data Viewer
+# messages of a phase were sent right after its onset, neither while the
+# keyboard is polled nor before the next onset flip. It fails on any
+# exception raised by the script, e.g., a missing import, so run it after
+# every change to V4:
+#
+#     python smoke_run.py
+
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import sys
+import json
+import glob
+import time
+import types
+import runpy
+import shutil
+import tempfile
+import contextlib
+import epochs
+import threading
+
+
+# keys returned by every event.getKeys() call: SPACEBAR ends the phases,
+# 1 answers the questions
+KEYS = [('space', {'ctrl': False}), ('1', {'ctrl': False})]
+# small window, the backdrops are converted at this size
+WINDOW_SIZE = (256, 160)
+EDF_NAME = 'smoke'
+# the tracker of the first run gets disconnected after this many recordings
+DISCONNECT_AFTER = 5
+
+
+class StubTracker(object):
+    """ EyeLink connection, every call is logged in calls as (thread name,
+    method, arguments, recording)"""
+
+    def __init__(self, disconnect_after=None):
+        """ Parameters:
+            disconnect_after--number of recordings before the tracker gets
+                              disconnected, never if None
+        """
+
+        self.calls = []
+        self.recording = False
+        self.connected = True
+        self._disconnect_after = disconnect_after
+        self._n_recordings = 0
+
+    def _log(self, name, args):
+        self.calls.append((threading.current_thread().name, name, args,
+                           self.recording))
+
+    def __getattr__(self, name):
+        # all the other Pylink calls succeed and return 0
+        def call(*args):
+            self._log(name, args)
+            return 0
+        return call
+
+    def isConnected(self, *args):
+        self._log('isConnected', args)
+        return self.connected
+
+    def isRecording(self, *args):
+        self._log('isRecording', args)
+        return 0 if self.recording and self.connected else -1
+
+    def startRecording(self, *args):
+        self._log('startRecording', args)
+        self.recording = True
+        self._n_recordings += 1
+        if self._disconnect_after is not None and \
+                self._n_recordings > self._disconnect_after:
+            self.connected = False
+        return 0
+
+    def stopRecording(self, *args):
+        self._log('stopRecording', args)
+        self.recording = False
+
+    def getTrackerVersionString(self, *args):
+        self._log('getTrackerVersionString', args)
+        return 'EYELINK CL 5.15'
+
+    def receiveDataFile(self, src, dest):
+        self._log('receiveDataFile', (src, dest))
+        with open(dest, 'wb') as f:
+            f.write(b'SR_RESEARCH stub EDF file\n')
+        return os.path.getsize(dest)
+
+    def messages(self):
+        """ Text of the messages sent to the tracker"""
+
+        return [args[0] for _, name, args, _ in self.calls
+                if name == 'sendMessage']
+
+
+def _module(name, **attributes):
+    """ Register a stub module in sys.modules"""
+
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install_stubs(tracker):
+    """ Replace Pylink, PsychoPy and the calibration graphics by stubs
+
+    Parameters:
+        tracker--the StubTracker the task will connect to
+    """
+
+    # Pylink
+    _module('pylink',
+            EyeLink=lambda address=None: tracker,
+            getEYELINK=lambda: tracker,
+            openGraphicsEx=lambda genv: None,
+            pumpDelay=lambda ms: None,
+            msecDelay=lambda ms: None,
+            TRIAL_OK=0, TRIAL_ERROR=-1, SKIP_TRIAL=1, REPEAT_TRIAL=2,
+            ABORT_EXPT=3, ESC_KEY=27, BX_MAXCONTRAST=1)
+
+    # PsychoPy
+    class Window(object):
+        def __init__(self, *args, **kwargs):
+            self.size = WINDOW_SIZE
+            self.color = (0, 0, 0)
+            self.fillColor = self.color
+            self._on_flip = []
+
+        def callOnFlip(self, function, *args, **kwargs):
+            self._on_flip.append((function, args, kwargs))
+
+        def flip(self, *args, **kwargs):
+            flip_time = time.perf_counter()
+            on_flip, self._on_flip = self._on_flip, []
+            for function, args, kwargs in on_flip:
+                function(*args, **kwargs)
+            return flip_time
+
+        def close(self):
+            pass
+
+    class Stim(object):
+        def __init__(self, win=None, text='', *args, **kwargs):
+            self.win = win
+            self.text = text
+            self.image = kwargs.get('image')
+
+        def draw(self, *args):
+            pass
+
+    class Dlg(object):
+        def __init__(self, title='', *args, **kwargs):
+            self.OK = True
+            self.data = []
+
+        def addText(self, *args, **kwargs):
+            pass
+
+        def addField(self, label, initial='', *args, **kwargs):
+            self.data.append(EDF_NAME if label == 'File Name:' else initial)
+
+        def show(self):
+            return self.data
+
+    def get_keys(keyList=None, modifiers=False, timeStamped=False):
+        if timeStamped:
+            return [(key, modifier, time.perf_counter())
+                    for key, modifier in KEYS]
+        return list(KEYS)
+
+    psychopy = _module('psychopy')
+    psychopy.visual = _module('psychopy.visual', Window=Window,
+                              ImageStim=Stim, TextStim=Stim)
+    psychopy.core = _module('psychopy.core', getTime=time.perf_counter,
+                            wait=time.sleep, quit=lambda: None)
+    psychopy.event = _module('psychopy.event',
+                             getKeys=get_keys,
+                             waitKeys=lambda *args, **kwargs: ['space'],
+                             clearEvents=lambda *args, **kwargs: None)
+    psychopy.monitors = _module('psychopy.monitors',
+                                Monitor=lambda *args, **kwargs: None)
+    psychopy.gui = _module('psychopy.gui', Dlg=Dlg)
+    console = types.SimpleNamespace(setLevel=lambda level: None)
+    psychopy.logging = _module('psychopy.logging', console=console,
+                               CRITICAL=50)
+
+    # calibration graphics
+    class CoreGraphics(object):
+        def __init__(self, tracker, win):
+            pass
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: None
+
+        def getForegroundColor(self):
+            return (-1, -1, -1)
+
+        def getBackgroundColor(self):
+            return (0, 0, 0)
+
+    _module('EyeLinkCoreGraphicsPsychoPy',
+            EyeLinkCoreGraphicsPsychoPy=CoreGraphics)
+
+
+def run_task(work_dir, tracker):
+    """ Run V4.py in work_dir with the stubs
+
+    Parameters:
+        work_dir--the copy of the script folder
+        tracker--the StubTracker the task will connect to
+    Returns the text printed by the task
+    """
+
+    install_stubs(tracker)
+    output = io.StringIO()
+    cwd = os.getcwd()
+    argv = sys.argv
+    sys.argv = [os.path.join(work_dir, 'V4.py')]
+    try:
+        # the task quits with sys.exit() after the EDF download
+        with contextlib.redirect_stdout(output):
+            runpy.run_path(sys.argv[0], run_name='__main__')
+    except SystemExit:
+        pass
+    finally:
+        sys.argv = argv
+        os.chdir(cwd)
+        sys.stdout.write(output.getvalue())
+
+    return output.getvalue()
+
+
+def main():
+    """ Run V4.py with stubs in a copy of the script folder, e.g., python
+    smoke_run.py"""
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the copy of the script folder')
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix='pupillometry_smoke_')
+    for f in glob.glob(os.path.join(script_dir, '*.py')) + \
+            glob.glob(os.path.join(script_dir, '*.csv')):
+        shutil.copy(f, work_dir)
+    shutil.copytree(os.path.join(script_dir, 'images'),
+                    os.path.join(work_dir, 'images'),
+                    ignore=shutil.ignore_patterns('.backdrops'))
+
+    sys.path.insert(0, work_dir)
+    t_start = time.perf_counter()
+    trackers = [StubTracker(DISCONNECT_AFTER), StubTracker()]
+    output = ''.join(run_task(work_dir, tracker) for tracker in trackers)
+    duration = time.perf_counter() - t_start
+
+    errors = []
+    calls = [call for tracker in trackers for call in tracker.calls]
+    messages = [message for tracker in trackers
+                for message in tracker.messages()]
+    if 'Resuming session' not in output:
+        errors.append('the session was not resumed')
+    # the EDF transfer thread is the only one talking to the tracker during
+    # the download
+    other_threads = set('%s.%s' % (thread, name)
+                        for thread, name, _, _ in calls
+                        if thread != 'MainThread' and
+                        (thread, name) != ('EDFTransfer', 'receiveDataFile'))
+    if other_threads:
+        errors.append('tracker called from other threads: %s' %
+                      ', '.join(sorted(other_threads)))
+    n_recording = sum(1 for _, name, _, recording in calls
+                      if name == 'bitmapBackdrop' and recording)
+    if n_recording:
+        errors.append('%d backdrops sent during a recording' % n_recording)
+    # the Data Viewer messages of a phase are sent after the onset message,
+    # before the first poll (isRecording) of the phase, see timeline.py
+    n_late = 0
+    state = None
+    for _, name, call_args, _ in calls:
+        if name == 'isRecording' and state == 'onset':
+            state = 'polling'
+        if name != 'sendMessage':
+            continue
+        message = call_args[0]
+        if message.endswith('_onset'):
+            state = 'onset'
+        elif message.startswith(('fin phase', 'key_pressed')):
+            state = 'ended'
+        elif message.startswith(epochs.PHASE_END_MESSAGES) or \
+                message == 'blank_screen':
+            # the trial is over, or aborted
+            state = None
+        elif state in ('polling', 'ended') and '!V ' in message:
+            n_late += 1
+    if n_late:
+        errors.append('%d Data Viewer messages sent after the first poll '
+                      'of their phase' % n_late)
+    checkpoints = glob.glob(os.path.join(work_dir, 'Resultats_Pupillometry',
+                                         EDF_NAME + '_*', 'checkpoint.json'))
+    if len(checkpoints) != 1:
+        errors.append('%d session checkpoints' % len(checkpoints))
+    else:
+        with open(checkpoints[0]) as f:
+            state = json.load(f)
+        # the test trial, then the trials of the plan
+        n_trials = len(state['plan']) + 1
+        n_ok = messages.count('TRIAL_RESULT 0')
+        if n_ok != n_trials:
+            errors.append('%d trials completed out of %d' %
+                          (n_ok, n_trials))
+        if not state['finished']:
+            errors.append('the checkpoint is not finished')
+        # the first run ends without the download, its segment is reported
+        # missing when the session is resumed
+        session_folder = os.path.dirname(checkpoints[0])
+        if len(state['segments']) != len(trackers):
+            errors.append('%d EDF segments' % len(state['segments']))
+        for i, (host_edf, local_edf, _) in enumerate(state['segments']):
+            downloaded = os.path.exists(os.path.join(session_folder,
+                                                     local_edf))
+            if i == 0 and downloaded:
+                errors.append('%s was downloaded after a disconnect' %
+                              local_edf)
+            elif i == 0 and 'segment %s is missing' % host_edf not in output:
+                errors.append('the missing %s was not reported' % local_edf)
+            elif i > 0 and not downloaded:
+                errors.append('%s was not downloaded' % local_edf)
+
+    print('')
+    print('smoke run: %d tracker calls, %d messages in %.1f s' %
+          (len(calls), len(messages), duration))
+    if args.keep:
+        print('  task folder: %s' % work_dir)
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if errors:
+        print('FAILED:\n  ' + '\n  '.join(errors))
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#########################################
+#
+# Pupillometry - PsychoPy stimulus registry
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# Creating a visual.ImageStim uploads the image to the graphics card as a new
+# texture. Doing so at the start of every trial adds jitter right before the
+# stimulus onset, so we build one ImageStim per image before the first trial
+# and only look them up in run_trial.
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+from psychopy import visual, core
+from PIL import Image
+
+
+class StimulusRegistry(object):
+    """ One full screen ImageStim per image file, built once per session"""
+
+    def __init__(self, win, size):
+        """ Parameters:
+            win--the PsychoPy window used for the task
+            size--(width, height) of the stimuli, usually the screen size
+        """
+
+        self._win = win
+        self._size = size
+        self._stims = {}
+        # source image size (bytes) and upload time (sec) of each stimulus
+        self._stats = {}
+
+    def __contains__(self, image_file):
+        return os.path.abspath(image_file) in self._stims
+
+    def _build(self, image_file):
+        """ Create the ImageStim and measure the texture upload"""
+
+        # size of the decoded source image, one byte per band; PsychoPy may
+        # upload a resized, power-of-two padded texture, so the texture
+        # memory is not measured here. PIL only reads the header
+        im = Image.open(image_file)
+        image_bytes = im.size[0]*im.size[1]*len(im.getbands())
+
+        t_start = core.getTime()
+        stim = visual.ImageStim(self._win,
+                                image=image_file,
+                                size=self._size)
+        upload_time = core.getTime() - t_start
+
+        self._stats[os.path.abspath(image_file)] = (image_bytes, upload_time)
+        return stim
+
+    def preload(self, image_files):
+        """ Build the ImageStim of all the images used in the task"""
+
+        for image_file in image_files:
+            key = os.path.abspath(image_file)
+            if key not in self._stims:
+                self._stims[key] = self._build(image_file)
+
+    def get(self, image_file):
+        """ Return the ImageStim of an image. An image that was not
+        preloaded gets its own stimulus, built now and kept for the next
+        trials"""
+
+        key = os.path.abspath(image_file)
+        stim = self._stims.get(key)
+        if stim is None:
+            print('WARNING: %s was not preloaded' % image_file)
+            stim = self._stims[key] = self._build(image_file)
+
+        return stim
+
+    def report(self):
+        """ Print the source image size and upload time of each stimulus;
+        the texture memory on the graphics card may be larger"""
+
+        total_bytes = 0
+        print('Preloaded stimuli:')
+        print('  %-20s %11s  %9s' % ('image', 'source', 'upload'))
+        for key in sorted(self._stats):
+            image_bytes, upload_time = self._stats[key]
+            total_bytes += image_bytes
+            print('  %-20s %8.1f KB  %6.1f ms' % (os.path.basename(key),
+                                               image_bytes/1024.0,
+                                               upload_time*1000))
+        print('  total source image size: %.1f MB' %
+              (total_bytes/1024.0**2))
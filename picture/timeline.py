@@ -0,0 +1,172 @@
+#########################################
+#
+# Pupillometry - trial timeline
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# A trial is a list of phases (baseline, image, rest, ...). Each phase shows a
+# stimulus for a maximum duration, logs its onset in the EDF file, loads its
+# image in Data Viewer and can be ended early with a key press. The phases
+# only differ by these parameters, so a trial is described as a list of Phase
+# records and run by a single loop.
+#
+# The Data Viewer messages, the key sets and the stimuli of all the phases are
+# prepared when the TrialTimeline is built, i.e., before startRecording(), so
+# nothing is formatted or allocated between the phase onsets. Only the onset
+# messages are sent on the flip, the Data Viewer messages are queued and sent
+# right after it, before the first poll of the phase, stamped back to the
+# flip time, see messages.MessageQueue. Nothing is sent to the tracker
+# between the end of a phase and the next onset flip, and the response
+# times come from the key timestamps, not from the polls.
+
+from __future__ import division
+from __future__ import print_function
+
+from collections import namedtuple
+import pylink
+from psychopy import event
+from messages import MessageQueue
+
+
+# name--phase name, used in the timing report
+# stim--the (preloaded) stimulus to show
+# duration--maximum duration of the phase (sec)
+# onset_msg--message sent to the tracker on the onset flip
+# imgload--image path for Data Viewer, relative to the EDF file, or None
+# end_msg--message sent when the phase runs for its whole duration, or None
+# keys--keys that end the phase early, the response time is recorded
+Phase = namedtuple('Phase', ['name', 'stim', 'duration', 'onset_msg',
+                             'imgload', 'end_msg', 'keys'])
+Phase.__new__.__defaults__ = (None, None, ('space',))
+
+
+class TrialTimeline(object):
+    """ Run the phases of a trial one after the other
+
+    Usage:
+        timeline = TrialTimeline(phases, phase_scheduler, el_tracker, ...)
+        # start recording
+        status, RTs = timeline.run()
+    """
+
+    def __init__(self, phases, scheduler, el_tracker, screen_size,
+                 bgcolor=(116, 116, 116), areas=(), msg_queue=None):
+        """ Parameters:
+            phases--list of Phase records, in order
+            scheduler--a timing.PhaseScheduler with a window
+            el_tracker--the active EyeLink connection
+            screen_size--(width, height) of the screen, in pixels
+            bgcolor--Data Viewer background color, (R, G, B)
+            areas--interest areas, (id, left, top, right, bottom, label),
+                   logged at the onset of every phase
+            msg_queue--the messages.MessageQueue used for the Data Viewer
+                       messages, a new one if None
+        """
+
+        self._scheduler = scheduler
+        self._el_tracker = el_tracker
+        if msg_queue is None:
+            msg_queue = MessageQueue(el_tracker)
+        self._msg_queue = msg_queue
+
+        # Data Viewer messages, see Data Viewer User Manual, "Protocol for
+        # EyeLink Data to Viewer Integration"
+        scn_width, scn_height = screen_size
+        clear_msg = '!V CLEAR %d %d %d' % tuple(bgcolor)
+        area_msgs = ['!V IAREA RECTANGLE %d %d %d %d %d %s' % ia_pars
+                     for ia_pars in areas]
+
+        # (phase, Data Viewer messages, keys ending the phase)
+        self._steps = []
+        for phase in phases:
+            messages = [clear_msg]
+            if phase.imgload is not None:
+                messages.append('!V IMGLOAD CENTER %s %d %d %d %d' %
+                                (phase.imgload,
+                                 int(scn_width/2.0), int(scn_height/2.0),
+                                 int(scn_width), int(scn_height)))
+            messages.extend(area_msgs)
+            self._steps.append((phase, tuple(messages),
+                                frozenset(phase.keys)))
+
+        # response time (ms) of each phase, -1 if no key was pressed
+        self.RTs = [-1]*len(self._steps)
+
+    def __len__(self):
+        return len(self._steps)
+
+    def run(self):
+        """ Show all the phases, the tracker must be recording
+
+        Returns (status, RTs), status is pylink.TRIAL_OK, pylink.SKIP_TRIAL
+        (ESCAPE pressed), pylink.ABORT_EXPT (Ctrl-C pressed) or the error
+        returned by isRecording(). Cleaning up after an aborted trial is
+        left to the caller.
+        """
+
+        el_tracker = self._el_tracker
+        scheduler = self._scheduler
+        RTs = self.RTs
+        msg_queue = self._msg_queue
+
+        try:
+            return self._run(el_tracker, scheduler, RTs, msg_queue)
+        finally:
+            # messages of a phase that was cut short
+            msg_queue.flush()
+
+    def _run(self, el_tracker, scheduler, RTs, msg_queue):
+        """ The phase loop, see run()"""
+
+        for i, (phase, messages, keys) in enumerate(self._steps):
+            # the onset message is sent on the flip and the phase starts at
+            # the flip time
+            onset_time = scheduler.present(phase.name, phase.stim,
+                                           el_tracker, phase.onset_msg)
+            # the Data Viewer messages are sent now that the stimulus is on
+            # screen, logged at the flip time
+            msg_queue.defer_all(messages, onset_time)
+            msg_queue.flush()
+
+            event.clearEvents()  # clear cached PsychoPy events
+            # the tracker and the keyboard are polled at the scheduler rate
+            for now in scheduler.phase(phase.name, onset_time,
+                                       phase.duration):
+                get_keypress = False
+
+                # abort the trial if the tracker is no longer recording
+                error = el_tracker.isRecording()
+                if error is not pylink.TRIAL_OK:
+                    el_tracker.sendMessage('tracker_disconnected')
+                    return error, RTs
+
+                # check keyboard events; the keys are stamped when they are
+                # pressed, on the core.getTime() clock of the flip time, so
+                # the response time does not depend on the poll rate
+                for keycode, modifier, key_time in event.getKeys(
+                        modifiers=True, timeStamped=True):
+                    # end the phase, and log the response time in ms
+                    if keycode in keys:
+                        el_tracker.sendMessage('key_pressed')
+                        RTs[i] = int((key_time - onset_time)*1000)
+                        get_keypress = True
+
+                    # skip the trial if "ESCAPE" is pressed
+                    if keycode == 'escape':
+                        el_tracker.sendMessage('trial_skipped_by_user')
+                        return pylink.SKIP_TRIAL, RTs
+
+                    # terminate the task if Ctrl-c
+                    if keycode == 'c' and (modifier['ctrl'] is True):
+                        el_tracker.sendMessage('terminated_by_user')
+                        return pylink.ABORT_EXPT, RTs
+
+                if get_keypress:
+                    break
+            else:
+                if phase.end_msg is not None:
+                    el_tracker.sendMessage(phase.end_msg)
+
+        return pylink.TRIAL_OK, RTs
@@ -0,0 +1,191 @@
+#########################################
+#
+# Pupillometry - trial phase timing
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# Each phase of a trial (baseline, image, rest, ...) lasts a fixed duration,
+# or until the participant presses a key. Checking the time, the tracker and
+# the keyboard in a tight loop pins a CPU core, which competes with PsychoPy
+# and with the Pylink link thread. The scheduler below polls at a fixed rate
+# and sleeps in between, and only spins for the last couple of milliseconds
+# before a phase deadline.
+#
+# The onset of each phase is locked to the screen flip: the onset message is
+# sent from win.callOnFlip(), right after the buffer swap, and the phase
+# duration counts from the flip time, so the EDF timestamps match what was
+# on screen.
+
+from __future__ import division
+from __future__ import print_function
+
+import time
+from psychopy import core
+
+
+def sleep_until(deadline, spin=0.002):
+    """ Sleep until deadline (PsychoPy clock, in sec), the last spin
+    seconds are busy-waited since sleep() may overshoot by a few ms"""
+
+    remaining = deadline - core.getTime()
+    if remaining > spin:
+        time.sleep(remaining - spin)
+    while core.getTime() < deadline:
+        pass
+
+
+class PhaseScheduler(object):
+    """ Wait for the end of each trial phase while polling the tracker and
+    keyboard at a configurable rate
+
+    Usage:
+        for now in phase_scheduler.phase('image', img_onset_time, 5.0):
+            # poll the tracker and keyboard here, break to end the phase
+        else:
+            # the phase ran for its whole duration
+    """
+
+    def __init__(self, poll_rate=200.0, win=None):
+        """ Parameters:
+            poll_rate--number of polls per second (Hz)
+            win--the PsychoPy window, needed by present(); if a stimulus is
+                 passed to phase(), the polls wait on frame flips instead of
+                 sleeping
+        """
+
+        self._poll_interval = 1.0/poll_rate
+        self._win = win
+        # timing of the phases of the current trial, see report()
+        self.phases = []
+        # planned onset of the next phase: the deadline of the previous
+        # phase, or its end if a key press ended it early
+        self._next_onset = None
+        # planned onset, flip time and onset message time of each phase,
+        # by phase name
+        self._planned_onsets = {}
+        self._flip_times = {}
+        self._message_times = {}
+
+    def start_trial(self):
+        """ Reset the timing report at the beginning of a trial"""
+
+        self.phases = []
+        self._next_onset = None
+        self._planned_onsets = {}
+        self._flip_times = {}
+        self._message_times = {}
+
+    def present(self, name, stim, el_tracker, message, planned_onset=None):
+        """ Show a stimulus on the next flip and log its onset
+
+        Parameters:
+            name--phase name, used in the report
+            stim--the stimulus to draw
+            el_tracker--the active EyeLink connection
+            message--onset message, sent right after the flip
+            planned_onset--time the phase should start (core.getTime()); by
+                           default the deadline of the previous phase (or
+                           its end, if a key press ended it), or now for the
+                           first phase of the trial
+        Returns the flip time, to pass as onset_time to phase()
+        """
+
+        if planned_onset is None:
+            planned_onset = self._next_onset
+        if planned_onset is None:
+            planned_onset = core.getTime()
+        self._planned_onsets[name] = planned_onset
+
+        stim.draw()
+        self._win.callOnFlip(self._send_onset, name, el_tracker, message)
+        flip_time = self._win.flip()
+        if flip_time is None:
+            flip_time = core.getTime()
+        self._flip_times[name] = flip_time
+
+        return flip_time
+
+    def _send_onset(self, name, el_tracker, message):
+        """ Called by PsychoPy right after the flip"""
+
+        el_tracker.sendMessage(message)
+        self._message_times[name] = core.getTime()
+
+    def phase(self, name, onset_time, duration, stim=None):
+        """ Yield the current time at each poll, until the phase deadline
+
+        Parameters:
+            name--phase name, used in the report
+            onset_time--onset of the phase (core.getTime())
+            duration--maximum duration of the phase (sec)
+            stim--stimulus to redraw on every frame when the scheduler has
+                  a window; the polls are then locked to the frame flips
+        """
+
+        deadline = onset_time + duration
+        # how late the phase started after its planned onset, known when the
+        # stimulus was shown with present()
+        onset_error = None
+        if name in self._planned_onsets:
+            onset_error = onset_time - self._planned_onsets[name]
+        timeout = False
+
+        try:
+            while True:
+                now = core.getTime()
+                if now >= deadline:
+                    timeout = True
+                    return
+                yield now
+
+                if self._win is not None and stim is not None:
+                    stim.draw()
+                    self._win.flip()
+                else:
+                    next_poll = core.getTime() + self._poll_interval
+                    if next_poll >= deadline:
+                        sleep_until(deadline)
+                    else:
+                        time.sleep(self._poll_interval)
+        finally:
+            end_time = core.getTime()
+            offset_error = None
+            if timeout:
+                offset_error = end_time - deadline
+            # delay between the flip and the onset message
+            message_delay = None
+            if name in self._flip_times and name in self._message_times:
+                message_delay = self._message_times[name] - \
+                    self._flip_times[name]
+            self.phases.append((name, onset_time, onset_error, offset_error,
+                                message_delay))
+            self._next_onset = deadline if timeout else end_time
+
+    def report(self):
+        """ Print the timing of each phase of the trial, in ms. The onset is
+        the flip time relative to the first phase, the onset error is the
+        flip time minus the planned onset (see present()), the offset error
+        is the end of the phase minus its deadline (phases ended by a key
+        press have none), and the message delay is the time between the
+        flip and the onset message"""
+
+        if len(self.phases) == 0:
+            return
+        first_onset = self.phases[0][1]
+
+        print('  phase         onset   onset error  offset error  msg delay')
+        for name, onset_time, onset_error, offset_error, message_delay in \
+                self.phases:
+            print('  %-10s %8s %13s %13s %10s' %
+                  (name, _ms(onset_time - first_onset), _ms(onset_error),
+                   _ms(offset_error), _ms(message_delay)))
+
+
+def _ms(seconds):
+    """ Format a duration in ms for the report"""
+
+    if seconds is None:
+        return '-'
+    return '%.2f ms' % (seconds*1000)
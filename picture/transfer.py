@@ -0,0 +1,174 @@
+#########################################
+#
+# Pupillometry - EDF file transfer
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# receiveDataFile() blocks until the whole EDF file is on the Display PC,
+# which takes a while for a long session recorded at 1000 Hz. Here the
+# transfer runs in a worker thread while the main thread shows its progress
+# on screen (the size of the local file as it grows, and the throughput).
+# The received size is checked against the size reported by Pylink, and a
+# failed transfer is retried.
+#
+# The worker thread is the only one talking to the tracker during the
+# transfer, the main thread only reads the local file size and draws.
+#
+# Once the file is downloaded, convert_to_asc() starts the SR Research
+# edf2asc converter in the background.
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import threading
+import subprocess
+from psychopy import visual, core
+
+
+class EDFTransfer(object):
+    """ Download an EDF file from the Host PC, with retries and a progress
+    display
+
+    Usage:
+        edf_transfer = EDFTransfer(el_tracker, win)
+        local_size = edf_transfer.download('TEST.EDF', local_edf)
+    """
+
+    def __init__(self, el_tracker, win=None, retries=3, color='black',
+                 wrap_width=None):
+        """ Parameters:
+            el_tracker--the active EyeLink connection
+            win--the PsychoPy window, no progress display if None
+            retries--number of attempts before giving up
+            color--color of the progress text
+            wrap_width--wrap width of the progress text, in pixels
+        """
+
+        self._el_tracker = el_tracker
+        self._win = win
+        self._retries = retries
+        self._msg = None
+        if win is not None:
+            self._msg = visual.TextStim(win, '', color=color,
+                                        wrapWidth=wrap_width)
+        # (attempt, bytes, seconds, error) of each attempt
+        self.attempts = []
+
+    def download(self, src, dest):
+        """ Transfer a file from the Host PC
+
+        Parameters:
+            src--the EDF file on the Host
+            dest--path of the local copy
+        Returns the size of the local file, raises RuntimeError if all the
+        attempts failed
+        """
+
+        self.attempts = []
+        error = None
+        for attempt in range(1, self._retries + 1):
+            # remove what is left of a failed attempt
+            if os.path.exists(dest):
+                os.remove(dest)
+
+            t_start = core.getTime()
+            size, error = self._receive(src, dest, attempt)
+            duration = core.getTime() - t_start
+
+            # check the size of the local copy
+            if error is None:
+                if size is None or size <= 0:
+                    error = 'receiveDataFile returned %r' % (size,)
+                elif not os.path.exists(dest):
+                    error = '%s was not created' % dest
+                elif os.path.getsize(dest) != size:
+                    error = 'received %d bytes out of %d' % \
+                        (os.path.getsize(dest), size)
+
+            self.attempts.append((attempt, size, duration, error))
+            if error is None:
+                print('EDF transfer: %d bytes in %.1f s (%.2f MB/s), '
+                      'attempt %d' % (size, duration,
+                                      size/1024.0**2/max(duration, 1e-6),
+                                      attempt))
+                return size
+
+            print('ERROR: EDF transfer attempt %d failed: %s' %
+                  (attempt, error))
+
+        raise RuntimeError('EDF transfer failed after %d attempts: %s' %
+                           (self._retries, error))
+
+    def _receive(self, src, dest, attempt):
+        """ Run receiveDataFile() in a worker thread and show the progress
+        until it returns. Returns (size, error message)"""
+
+        result = {'size': None, 'error': None}
+
+        def receive():
+            try:
+                result['size'] = self._el_tracker.receiveDataFile(src, dest)
+            except RuntimeError as error:
+                result['error'] = str(error)
+
+        worker = threading.Thread(target=receive, name='EDFTransfer')
+        worker.daemon = True
+        worker.start()
+
+        t_start = core.getTime()
+        while worker.is_alive():
+            if self._msg is None:
+                worker.join(0.1)
+                continue
+            # the local file grows as the data arrives
+            received = 0
+            if os.path.exists(dest):
+                received = os.path.getsize(dest)
+            elapsed = core.getTime() - t_start
+            self._msg.text = ('EDF data is transferring from EyeLink Host '
+                              'PC...\n\n%.1f MB received in %.0f s '
+                              '(%.2f MB/s)' %
+                              (received/1024.0**2, elapsed,
+                               received/1024.0**2/max(elapsed, 1e-6)))
+            if attempt > 1:
+                self._msg.text += '\n\nattempt %d of %d' % (attempt,
+                                                            self._retries)
+            self._msg.draw()
+            self._win.flip()
+            # a few updates per second are enough
+            worker.join(0.2)
+
+        return result['size'], result['error']
+
+
+def convert_to_asc(edf_path, edf2asc='edf2asc', options=('-y',), wait=False):
+    """ Convert an EDF file to ASC with SR Research edf2asc
+
+    Parameters:
+        edf_path--the local EDF file
+        edf2asc--the converter, looked up in the PATH
+        options--command line options, -y overwrites an existing ASC file
+        wait--wait for the conversion to finish, otherwise it runs in the
+              background, even after the task quits
+    Returns the subprocess.Popen of the converter, None if edf2asc is not
+    installed
+    """
+
+    converter = shutil.which(edf2asc)
+    if converter is None:
+        print('WARNING: %s not found, %s was not converted' %
+              (edf2asc, edf_path))
+        return None
+
+    process = subprocess.Popen([converter] + list(options) + [edf_path])
+    if wait:
+        process.wait()
+        print('%s converted in %s' % (edf_path,
+                                      os.path.splitext(edf_path)[0] +
+                                      '.asc'))
+
+    return process
@@ -0,0 +1,325 @@
+#########################################
+#
+# Pupillometry - trial list generation
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# The trials of a session are described in a CSV or JSON file, one row per
+# (condition, image) with an optional number of repeats, e.g.
+#
+#     condition,image,repeats
+#     cond_1,img_1.png,1
+#     cond_2,img_2.png,1
+#
+# or, in JSON, [{"condition": "cond_1", "image": "img_1.png"}, ...] or
+# {"trials": [...]}.
+#
+# make_plan() turns this list into the sequence of trials of the session:
+# the session is split in blocks, each block holds every trial of the list
+# the same number of times (counterbalancing), in a random order where the
+# same condition is never repeated more than max_run times in a row. The
+# sequence is drawn one trial at a time from per condition pools, the
+# counts of the pools are kept in a Fenwick tree, so the cost is
+# O(n log c) for n trials and c conditions.
+#
+# validate() opens the header of every image before the task starts, so a
+# missing or broken file is reported before the first trial and not in the
+# middle of a session. The image sizes it returns are checked against the
+# screen with check_aspect_ratio() once the window is open.
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import csv
+import json
+import random
+from collections import namedtuple, OrderedDict
+from PIL import Image
+
+
+# one trial, unpacked in run_trial as cond, pic = trial_pars
+Trial = namedtuple('Trial', ['cond', 'pic'])
+
+
+def load_spec(spec_file):
+    """ Read the trial list from a CSV or JSON file
+
+    Parameters:
+        spec_file--path of the file, the format is given by its extension
+    Returns a list of Trial, a trial with n repeats appears n times
+    """
+
+    ext = os.path.splitext(spec_file)[1].lower()
+    if ext == '.json':
+        with open(spec_file) as f:
+            rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = rows['trials']
+    elif ext == '.csv':
+        with open(spec_file) as f:
+            rows = list(csv.DictReader(f))
+    else:
+        raise ValueError('Unknown trial list format: %s' % spec_file)
+
+    trials = []
+    for n, row in enumerate(rows):
+        try:
+            trial = Trial(str(row['condition']).strip(),
+                          str(row['image']).strip())
+            repeats = int(row.get('repeats') or 1)
+        except (KeyError, ValueError):
+            raise ValueError('%s: invalid trial %d: %r' %
+                             (spec_file, n + 1, row))
+        trials.extend([trial]*repeats)
+
+    if len(trials) == 0:
+        raise ValueError('%s: no trials' % spec_file)
+
+    return trials
+
+
+def validate(trials, image_dir, extra_images=()):
+    """ Check that all the images of the task can be opened
+
+    Parameters:
+        trials--the list of Trial
+        image_dir--the folder of the images
+        extra_images--other images of the task, e.g., the baseline
+    Returns a dict {image: (width, height)}, raises ValueError listing all
+    the broken images
+    """
+
+    images = OrderedDict()
+    for pic in extra_images:
+        images[pic] = None
+    for trial in trials:
+        images[trial.pic] = None
+
+    errors = []
+    for pic in images:
+        image_file = os.path.join(image_dir, pic)
+        try:
+            # only the header is read here
+            im = Image.open(image_file)
+            images[pic] = im.size
+            im.close()
+        except (IOError, OSError) as error:
+            errors.append('%s: %s' % (image_file, error))
+            continue
+
+        width, height = images[pic]
+        if width == 0 or height == 0:
+            errors.append('%s: empty image' % image_file)
+
+    if errors:
+        raise ValueError('Invalid images:\n  ' + '\n  '.join(errors))
+
+    return images
+
+
+def check_aspect_ratio(images, image_dir, size):
+    """ Report the images whose aspect ratio differs from the screen's,
+    since they are stretched to full screen; no file is opened
+
+    Parameters:
+        images--{image: (width, height)} returned by validate()
+        image_dir--the folder of the images, used in the messages
+        size--(width, height) of the screen
+    Returns the list of the stretched images
+    """
+
+    stretched = []
+    for pic, (width, height) in images.items():
+        if abs(width*size[1] - height*size[0]) > 0.01*width*size[1]:
+            print('WARNING: %s is %dx%d, it will be stretched to %dx%d' %
+                  (os.path.join(image_dir, pic), width, height,
+                   size[0], size[1]))
+            stretched.append(pic)
+
+    return stretched
+
+
+def make_plan(trials, repeats=1, n_blocks=1, max_run=None, seed=None,
+              max_attempts=100):
+    """ Build the randomized sequence of trials of a session
+
+    Parameters:
+        trials--the list of Trial
+        repeats--number of times each trial is shown over the session
+        n_blocks--number of blocks, repeats must be a multiple of n_blocks
+        max_run--maximum number of trials of the same condition in a row,
+                 no limit if None
+        seed--seed of the random generator, to replay a session
+        max_attempts--number of times a block is drawn again when the
+                      condition constraint leads to a dead end
+    Returns the list of Trial
+    """
+
+    if repeats % n_blocks != 0:
+        raise ValueError('%d repeats can not be split in %d blocks' %
+                         (repeats, n_blocks))
+    rng = random.Random(seed)
+    block = list(trials)*(repeats//n_blocks)
+
+    plan = []
+    for _ in range(n_blocks):
+        # the constraint also holds across the block boundary
+        last_cond, run = None, 0
+        if plan:
+            last_cond = plan[-1].cond
+            run = 1
+            while run < len(plan) and plan[-run - 1].cond == last_cond:
+                run += 1
+
+        for _ in range(max_attempts):
+            sequence = _draw_block(block, max_run, last_cond, run, rng)
+            if sequence is not None:
+                break
+        else:
+            raise ValueError('No sequence with at most %d trials of the '
+                             'same condition in a row' % max_run)
+        plan.extend(sequence)
+
+    return plan
+
+
+class _CountTree(object):
+    """ Fenwick tree of the number of trials left in each condition, to
+    draw a condition in proportion of its count in O(log c)"""
+
+    def __init__(self, counts):
+        self.total = 0
+        self._n = len(counts)
+        self._tree = [0]*(self._n + 1)
+        for i, count in enumerate(counts):
+            self.add(i, count)
+        # largest power of two <= n, for the descent in find()
+        self._top = 1
+        while self._top*2 <= self._n:
+            self._top *= 2
+
+    def add(self, i, delta):
+        """ Add delta to the count of condition i"""
+
+        self.total += delta
+        i += 1
+        while i <= self._n:
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        """ Sum of the counts of the conditions before i"""
+
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, value):
+        """ Condition i such that prefix(i) <= value < prefix(i + 1)"""
+
+        i = 0
+        step = self._top
+        while step:
+            if i + step <= self._n and self._tree[i + step] <= value:
+                i += step
+                value -= self._tree[i]
+            step //= 2
+        return i
+
+
+def _draw_block(block, max_run, last_cond, run, rng):
+    """ Draw one random order of the block, None on a dead end
+
+    Each trial picks a condition in proportion of its remaining trials,
+    leaving out the condition that reached max_run; with the counts in a
+    _CountTree the block costs O(n log c) for n trials and c conditions.
+    """
+
+    # shuffled pool of trials of each condition
+    pools = OrderedDict()
+    for trial in block:
+        pools.setdefault(trial.cond, []).append(trial)
+    conds = list(pools)
+    index = dict((cond, i) for i, cond in enumerate(conds))
+    pools = [pools[cond] for cond in conds]
+    for pool in pools:
+        rng.shuffle(pool)
+    counts = _CountTree([len(pool) for pool in pools])
+
+    sequence = []
+    for _ in range(len(block)):
+        # the condition that can not be drawn now, if any
+        blocked = None
+        blocked_count = 0
+        if max_run is not None and run >= max_run and last_cond in index:
+            blocked = index[last_cond]
+            blocked_count = len(pools[blocked])
+        available = counts.total - blocked_count
+        if available <= 0:
+            return None
+
+        # draw among the other conditions by skipping over the blocked one
+        value = rng.randrange(available)
+        if blocked is not None and value >= counts.prefix(blocked):
+            value += blocked_count
+        i = counts.find(value)
+
+        sequence.append(pools[i].pop())
+        counts.add(i, -1)
+        cond = conds[i]
+        if cond == last_cond:
+            run += 1
+        else:
+            last_cond, run = cond, 1
+
+    return sequence
+
+
+def main():
+    """ Generate a plan and print its size, run time and longest run of the
+    same condition, e.g., python trialplan.py trials.csv --repeats 50;
+    with --scaling, also time 100000 trials over 4 to 5000 conditions"""
+
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('spec', help='CSV or JSON trial list')
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--blocks', type=int, default=1)
+    parser.add_argument('--max-run', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--scaling', action='store_true',
+                        help='time synthetic plans with many conditions')
+    args = parser.parse_args()
+
+    def run_plan(trials, repeats):
+        t_start = time.time()
+        plan = make_plan(trials, repeats, args.blocks, args.max_run,
+                         args.seed)
+        duration = time.time() - t_start
+
+        longest = run = 1
+        for previous, trial in zip(plan, plan[1:]):
+            run = run + 1 if trial.cond == previous.cond else 1
+            longest = max(longest, run)
+        print('%d trials in %.1f ms, longest run of a condition: %d' %
+              (len(plan), duration*1000, longest))
+
+    run_plan(load_spec(args.spec), args.repeats)
+
+    if args.scaling:
+        # 5000 images shown 20 times, spread over more and more conditions
+        for n_conds in (4, 100, 1000, 5000):
+            print('%4d conditions: ' % n_conds, end='')
+            run_plan([Trial('cond_%d' % (i % n_conds), 'img_%d.png' % i)
+                      for i in range(5000)], 20)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#########################################
+#
+# Pupillometry - trial variables table
+# Last Editor : Duhamel Noe
+# Last Edit : 17/10/26
+#
+#########################################
+
+# Gather the trial variables of a session into one table, one row per trial
+# in the same order as the rows of epochs.TrialIndex, so the table and the
+# epochs can be joined on the row:
+#
+#     index = epochs.TrialIndex(data)
+#     table = trialtable.trial_table(data, index)
+#     rows, pupil = index.epochs('image')
+#     keep = table.mask(condition='cond_1')[rows]
+#
+# The columns come from the messages of run_trial() and show_question():
+#
+#     !V TRIAL_VAR <name> <value>     condition, image, RT_base, RT_img, ...
+#     il a appuyer sur le bouton du clavier numero N
+#                                     answer to the question asked after the
+#                                     trial, in the 'answer' column
+#
+# Numeric variables are int64 (float64 if some are not integers, or if some
+# trials don't have them, with NaN for the missing values). Text variables,
+# condition and image are categorical: the column holds int64 codes in
+# table.categories[name], -1 for a missing value, as pandas.Categorical.
+# TrialTable.to_pandas() gives the pandas DataFrame, and from there Arrow,
+# e.g., pyarrow.Table.from_pandas(table.to_pandas()).
+
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+import numpy
+import epochs
+
+
+TRIAL_VAR = '!V TRIAL_VAR '
+ANSWER = 'il a appuyer sur le bouton du clavier numero '
+# always categorical, even if the values look like numbers
+CATEGORICAL = ('condition', 'image')
+# answer of a trial without any
+NO_ANSWER = -1
+
+
+class TrialTable(object):
+    """ Columns of the trial variables, one row per trial
+
+    Attributes:
+        columns--OrderedDict {name: array}
+        categories--{name: array of the labels} of the categorical columns
+    """
+
+    def __init__(self, columns, categories):
+        """ Parameters:
+            columns--OrderedDict {name: array}, all of the same length
+            categories--{name: labels}, the categorical columns hold codes
+                        in these labels
+        """
+
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def labels(self, name):
+        """ Values of a categorical column as labels, None if missing"""
+
+        codes = self.columns[name]
+        labels = numpy.append(self.categories[name].astype(object), None)
+        # code -1 is the last item, None
+        return labels[codes]
+
+    def mask(self, **criteria):
+        """ Select trials, e.g., table.mask(condition=['cond_1', 'cond_2'],
+        answer=4)
+
+        Parameters:
+            criteria--column=value or column=list of values; the values of
+                      categorical columns are labels
+        Returns a boolean array, one item per trial
+        """
+
+        selected = numpy.ones(len(self), dtype=numpy.bool_)
+        for name, values in criteria.items():
+            if numpy.isscalar(values):
+                values = [values]
+            column = self.columns[name]
+            if name in self.categories:
+                # compare the codes, not the labels
+                categories = list(self.categories[name])
+                values = [categories.index(v) for v in values
+                          if v in categories]
+            selected &= numpy.isin(column, values)
+
+        return selected
+
+    def rows(self, **criteria):
+        """ Rows of the trials selected by mask()"""
+
+        return numpy.flatnonzero(self.mask(**criteria))
+
+    def to_pandas(self):
+        """ The table as a pandas DataFrame, with pandas.Categorical
+        columns; requires pandas"""
+
+        import pandas
+
+        data = OrderedDict()
+        for name, column in self.columns.items():
+            if name in self.categories:
+                column = pandas.Categorical.from_codes(
+                    column, self.categories[name])
+            data[name] = column
+
+        return pandas.DataFrame(data)
+
+
+def trial_table(data, index=None):
+    """ Build the table of the trial variables of a session
+
+    Parameters:
+        data--an asc.ASCData, from asc.read_asc() or edf.read_edf()
+        index--the epochs.TrialIndex of data, built here if None
+    Returns a TrialTable
+    """
+
+    if index is None:
+        index = epochs.TrialIndex(data)
+    n_trials = len(index)
+
+    # the trial of each message: the last trial started at or before it;
+    # the answer comes after the TRIAL_RESULT, before the next TRIALID
+    times = data.messages['time']
+    texts = data.messages['text']
+    trial_rows = numpy.searchsorted(index.trials['start_time'], times,
+                                    side='right') - 1
+
+    values = OrderedDict()
+    answers = numpy.full(n_trials, NO_ANSWER, dtype=numpy.int64)
+    for row, text in zip(trial_rows, texts):
+        if row < 0:
+            continue
+        # an offset may come before the message, see messages.py
+        start = text.find(TRIAL_VAR)
+        if start >= 0:
+            words = text[start + len(TRIAL_VAR):].split(None, 1)
+            if words:
+                value = words[1].strip() if len(words) > 1 else ''
+                values.setdefault(words[0], {})[row] = value
+        elif text.startswith(ANSWER) and answers[row] == NO_ANSWER:
+            try:
+                answers[row] = int(text[len(ANSWER):])
+            except ValueError:
+                pass
+
+    columns = OrderedDict()
+    categories = {}
+    columns['trial_id'] = index.trials['trial_id']
+    columns['result'] = index.trials['result']
+    for name, column_values in values.items():
+        columns[name], labels = _typed_column(name, column_values, n_trials)
+        if labels is not None:
+            categories[name] = labels
+    columns['answer'] = answers
+
+    return TrialTable(columns, categories)
+
+
+def _typed_column(name, values, n_trials):
+    """ Array of a trial variable from {row: text}
+
+    Returns (array, None) for a numeric column, (codes, labels) for a
+    categorical one
+    """
+
+    if name not in CATEGORICAL:
+        try:
+            numbers = {row: float(value) for row, value in values.items()}
+        except ValueError:
+            numbers = None
+        if numbers is not None:
+            column = numpy.full(n_trials, numpy.nan)
+            rows = numpy.fromiter(numbers.keys(), dtype=numpy.int64)
+            column[rows] = numpy.fromiter(numbers.values(),
+                                          dtype=numpy.float64)
+            if len(numbers) == n_trials and \
+                    numpy.all(column == numpy.round(column)):
+                column = column.astype(numpy.int64)
+            return column, None
+
+    # categorical, the labels in the order of their first trial
+    labels = []
+    codes = numpy.full(n_trials, -1, dtype=numpy.int64)
+    label_codes = {}
+    for row in sorted(values):
+        value = values[row]
+        if value not in label_codes:
+            label_codes[value] = len(labels)
+            labels.append(value)
+        codes[row] = label_codes[value]
+
+    return codes, numpy.array(labels, dtype=object)
+
+
+def main():
+    """ Print the trial variables of an EDF or ASC file, and the time to
+    build the table, e.g., python trialtable.py
+    Resultats_Pupillometry/<session>/<session>.EDF"""
+
+    import argparse
+    import os
+    import time
+    import asc
+    import edf
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('data_file', help='EDF or ASC file')
+    args = parser.parse_args()
+
+    if os.path.splitext(args.data_file)[1].lower() == '.edf':
+        data = edf.read_edf(args.data_file)
+    else:
+        data = asc.read_asc(args.data_file)
+
+    t_start = time.perf_counter()
+    index = epochs.TrialIndex(data)
+    table = trial_table(data, index)
+    duration = time.perf_counter() - t_start
+    print('%d trials, %d columns in %.2f ms' %
+          (len(table), len(table.columns), duration*1000))
+
+    names = list(table.columns)
+    print('  '.join(names))
+    decoded = [table.labels(name) if name in table.categories else
+               table.columns[name] for name in names]
+    for row in range(len(table)):
+        print('  '.join(str(column[row]) for column in decoded))
+
+
+if __name__ == '__main__':
+    main()